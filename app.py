@@ -1,37 +1,50 @@
+import time
 import traceback
 
 from util import *
 import hmac
 import hashlib
+import config
 from message import *
 import chatbot
 import facebook
+import cache
+import ingest
+import scoring
+import forwarding
+import metrics
+import tracing
 from form import ConfessionForm
-from database import Confession, Page, Base
-from facebook import FBPage
+from database import Confession, Base, removeSession, sessionScope
 from sqlalchemy.exc import SQLAlchemyError, IntegrityError
 
-from flask import Flask, request, g, render_template, redirect, url_for, abort, Response
+from flask import Flask, request, render_template, redirect, url_for, abort, Response
 from flask_bootstrap import Bootstrap
 from flask_wtf.csrf import CSRFProtect
 from rq.decorators import job
 
-import requests
-
 import worker
 rqCon = worker.conn
 
-app = Flask(__name__)
+class ConfessionsApp(Flask):
+    @property
+    def secret_key(self):
+        """ Read when sessions and CSRF tokens are used, so the worker can import this module without it. """
+        return config.verifyToken()
+
+
+app = ConfessionsApp(__name__)
 Bootstrap(app)
 csrf = CSRFProtect(app)
 
+# When set, /metrics requires "Authorization: Bearer <METRICS_TOKEN>".
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
 
-VERIFY_TOKEN = os.environ["VERIFY_TOKEN"]
-app.secret_key = VERIFY_TOKEN
-
-CLIENT_SECRET = os.environ["CLIENT_SECRET"]
+# "rq" enqueues a job per event from the webhook, "stream" only appends the request to a Redis Stream (see ingest.py).
+WEBHOOK_INGEST = os.environ.get("WEBHOOK_INGEST", "rq")
 
 app.config.update(PREFERRED_URL_SCHEME='https')
+app.teardown_appcontext(removeSession)
 
 SERVER_NAME = os.environ.get("SERVER_NAME")
 if SERVER_NAME:
@@ -44,7 +57,7 @@ def verify():
     # when the endpoint is registered as a webhook, it must echo back
     # the 'hub.challenge' value it receives in the query arguments
     if request.args.get("hub.mode") == "subscribe" and request.args.get("hub.challenge"):
-        if not request.args.get("hub.verify_token") == VERIFY_TOKEN:
+        if not request.args.get("hub.verify_token") == config.verifyToken():
             return "Verification token mismatch", 403
         return request.args["hub.challenge"], 200
 
@@ -77,32 +90,33 @@ def confession_form(pageID):
     if form.validate_on_submit():
         text = form.confession.data
         confession = Confession()
-        confession.text = text.strip()
+        confession.setText(text.strip())
         confession.page_id = pageID
-        try:
-            confession.add()
-            if not confession.page.hasPendingConfession():
-                try:
-                    adminBot.sendFreshConfession(confession.page)
-                except RuntimeError:
-                    log("Failed to send fresh confession to page admin")
-
-            log("new confession id: " + str(confession.id))
-            return redirect(url_for('confession_status', confessionID=confession.id))
-        except IntegrityError as e:
-            log(str(e))
-            Base.session.rollback()
+        if Confession.isDuplicate(pageID, confession.text_hash):
             form.confession.errors.append("This confession has already been submitted.")
-        except SQLAlchemyError as e:
-            log(str(e))
-            Base.session.rollback()
-            form.confession.errors.append("Your confession is not valid.")
-    page = Page.findById(pageID)
-    if page:
-        fbPage = FBPage(page)
-        profilePic = fbPage.getProfilePictureUrl()
-        cover = fbPage.getCoverPictureUrl()
-        return render_template('confession_form.html', form=form, pageName=page.name, profilePic=profilePic, cover=cover)
+        else:
+            try:
+                confession.add()
+                scoring.scoreLater(confession)
+                if not confession.page.hasPendingConfession():
+                    try:
+                        adminBot.sendFreshConfession(confession.page)
+                    except RuntimeError:
+                        log("Failed to send fresh confession to page admin")
+
+                log("new confession id: {}", confession.id)
+                return redirect(url_for('confession_status', confessionID=confession.id))
+            except IntegrityError as e:     # submitted twice at the same time
+                log(str(e))
+                Base.session.rollback()
+                form.confession.errors.append("This confession has already been submitted.")
+            except SQLAlchemyError as e:
+                log(str(e))
+                Base.session.rollback()
+                form.confession.errors.append("Your confession is not valid.")
+    pageInfo = cache.getPageInfo(pageID)
+    if pageInfo:
+        return render_template('confession_form.html', form=form, pageName=pageInfo["name"], profilePic=pageInfo["profilePic"], cover=pageInfo["cover"])
     else:
         abort(404)
 
@@ -123,6 +137,7 @@ def confession_status(confessionID):
 @csrf.exempt
 def webhook():
     """ endpoint for processing incoming messaging events. """
+    start = time.time()
     try:
         if validateRequest(request):
             receivedRequest(request)
@@ -135,10 +150,21 @@ def webhook():
         adminBot.exceptionOccured(e)
         traceback.print_exc()
         raise e
+    finally:
+        metrics.observe("webhook_seconds", time.time() - start, ingest=WEBHOOK_INGEST)
 
     return "ok", 200
 
 
+@app.route('/metrics', methods=['GET'])
+@csrf.exempt
+def metrics_endpoint():
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get("Authorization", ""), "Bearer " + METRICS_TOKEN):
+        abort(401)
+    body, contentType = metrics.exposition()
+    return Response(body, content_type=contentType)
+
+
 def validateRequest(request):
     advertised = request.headers.get("X-Hub-Signature")
     if advertised is None:
@@ -148,7 +174,7 @@ def validateRequest(request):
     data = request.get_data()
 
     received = hmac.new(
-        key=CLIENT_SECRET.encode('raw_unicode_escape'),
+        key=config.clientSecret().encode('raw_unicode_escape'),
         msg=data,
         digestmod=hashlib.sha1
     ).hexdigest()
@@ -160,46 +186,58 @@ def validateRequest(request):
 
 
 def receivedRequest(request):
-    data = request.get_json()
-    debug(data)
+    """ Starts the trace of the request, its id is passed on to the jobs. """
+    with tracing.activate(tracing.newTrace()), tracing.span("webhook", ingest=WEBHOOK_INGEST):
+        if WEBHOOK_INGEST == "stream":
+            ingest.append(request.get_data(), request.headers.get("X-Hub-Signature"), tracing.currentTrace())
+            return
+
+        data = request.get_json()
+        debug(data)
+        headers = forwarding.forwardHeaders(dict(request.headers))
+        dispatchEvents(data, request.get_data(), headers, enqueue)
+
 
+def enqueue(handler, *args):
+    with tracing.span("enqueue", job=handler.__name__):
+        handler.delay(*args, traceID=tracing.currentTrace())
+
+
+def dispatchEvents(data, body, headers, run):
+    """ Call run(handler, *args) for every messaging event in the webhook data. """
     if data["object"] == "page":
+        destinations = set()
 
         for entry in data["entry"]:
             for messaging_event in entry["messaging"]:
                 sender = messaging_event["sender"]["id"]        # the facebook ID of the person sending you the message
                 recipient = messaging_event["recipient"]["id"]  # the recipient's ID, which should be your page's facebook ID
 
-                # Don't mind this piece of code. It forwards requests from specific pages to another bot.
-                if recipient in ["942723909080518", "1911537602473957"]:
-                    forward('https://party-post.herokuapp.com/messenger')
-                    return
+                # Events for some pages are handled by another bot, it receives the whole request once.
+                destination = forwarding.getDestination(recipient)
+                if destination:
+                    destinations.add(destination)
+                    continue
 
                 if messaging_event.get("message"):  # someone sent us a message
                     message = messaging_event["message"].get("text")
                     if not message:
-                        log("Received message without text from {}.".format(str(sender)))
+                        log("Received message without text from {}.", sender)
                         message = ""
-                    receivedMessage.delay(sender, recipient, message)
+                    run(receivedMessage, sender, recipient, message)
 
                 if messaging_event.get("postback"):  # user clicked/tapped "postback" button in earlier message
                     payload = messaging_event["postback"]["payload"]  # the message's text
-                    receivedPostback.delay(sender, recipient, payload)
-
+                    run(receivedPostback, sender, recipient, payload)
 
-def forward(destinationUrl):
-    """ Forward requests to other bot. Source: https://stackoverflow.com/a/36601467 """
-    resp = requests.request(
-        method=request.method,
-        url=destinationUrl,
-        headers={key: value for (key, value) in request.headers if key != 'Host'},
-        data=request.get_data(),
-        cookies=request.cookies,
-        allow_redirects=False)
+        for destination in destinations:
+            run(forwarding.forward, destination, body, headers)
 
 
-@job('low', connection=rqCon)
-def receivedMessage(sender, recipient, message):
+@job(worker.MESSAGES, connection=rqCon)
+@sessionScope
+def receivedMessage(sender, recipient, message, traceID=None):
+    """ The worker continues the trace of traceID, see worker.py. """
     if sender == recipient:  # filter messages to self
         return
 
@@ -210,8 +248,9 @@ def receivedMessage(sender, recipient, message):
         traceback.print_exc()
 
 
-@job('low', connection=rqCon)
-def receivedPostback(sender, recipient, payload):
+@job(worker.POSTBACKS, connection=rqCon)
+@sessionScope
+def receivedPostback(sender, recipient, payload, traceID=None):
     try:
         with app.app_context():
             adminBot.receivedPostback(sender, recipient, payload)
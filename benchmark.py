@@ -0,0 +1,77 @@
+import sys
+import time
+import subprocess
+
+import bacli
+from rq import Queue
+from rq.job import JobStatus
+
+import worker
+
+bacli.setDescription("Benchmarks of the worker and of startup")
+
+BENCHMARK_QUEUE = "benchmark"
+
+# What gunicorn and the worker import before they handle anything.
+STARTUP = {
+    "app": ["app"],
+    "worker": ["worker", "database", "metrics"] + worker.JOB_MODULES,
+}
+
+
+@bacli.command
+def workers(jobs: int=200, threads: int=worker.WORKER_THREADS, url: str=""):
+    """
+    Jobs per second of the forking worker and the pooled worker, for jobs that query the database
+    and GET url when given (e.g. a local stand-in for the Graph API).
+    """
+    for mode in ("fork", "pool"):
+        finished, elapsed = runJobs(mode, jobs, threads, url or None)
+        print("{:<5} {:>5} of {} jobs in {:6.2f}s, {:8.1f} jobs/s".format(mode, finished, jobs, elapsed, finished / elapsed))
+
+
+def runJobs(mode, jobs, threads, url):
+    """ Enqueue the jobs and run a worker in burst mode until they are done, returns (finished jobs, seconds). """
+    queue = Queue(BENCHMARK_QUEUE, connection=worker.conn)
+    queue.empty()
+    enqueued = [queue.enqueue(worker.probe, url) for _ in range(jobs)]
+
+    if mode == "pool":
+        benchmarkWorker = worker.PooledWorker([queue], threads=threads, connection=worker.conn)
+    else:
+        benchmarkWorker = worker.ModelWorker([queue], connection=worker.conn)
+    start = time.time()
+    benchmarkWorker.work(burst=True, logging_level="WARNING")
+    elapsed = time.time() - start
+
+    finished = sum(1 for job in enqueued if job.get_status() == JobStatus.FINISHED)
+    return finished, elapsed
+
+
+@bacli.command
+def startup(repeat: int=5, modules: int=0):
+    """ Time to import what the app and the worker need in a new process, with modules 1 per module in import order. """
+    for name, imports in STARTUP.items():
+        times = sorted(importTimes(imports)[-1][1] for _ in range(repeat))
+        print("{:<7} min {:6.3f}s, median {:6.3f}s".format(name, times[0], times[len(times) // 2]))
+        if modules:
+            previous = 0.0
+            for module, elapsed in importTimes(imports):
+                print("    {:<12} {:6.3f}s".format(module, elapsed - previous))
+                previous = elapsed
+
+
+def importTimes(imports):
+    """ Returns list of (module, seconds from the first import in a new interpreter until the module was imported). """
+    code = "import time, importlib\n" \
+           "start = time.time()\n" \
+           "for name in {!r}:\n" \
+           "    importlib.import_module(name)\n" \
+           "    print(name, time.time() - start)\n".format(imports)
+    output = subprocess.check_output([sys.executable, "-c", code], universal_newlines=True)
+    result = list()
+    for line in output.splitlines():
+        module, _, elapsed = line.rpartition(" ")
+        if module in imports:
+            result.append((module, float(elapsed)))
+    return result
@@ -0,0 +1,98 @@
+import time
+import json
+
+from util import *
+from rq.decorators import job
+from worker import conn, BACKGROUND
+from database import Page, sessionScope
+from facebook import FBPage
+
+# Entries younger than the TTL are served as is, older ones are served stale while they are refreshed.
+PAGE_CACHE_TTL = int(os.environ.get("PAGE_CACHE_TTL", 6 * 3600))
+# Entries are kept this long past their TTL as a fallback for when refreshing fails.
+PAGE_CACHE_STALE = int(os.environ.get("PAGE_CACHE_STALE", 7 * 24 * 3600))
+# Entries with a failed Graph lookup are kept this long, so the next requests do not all call Graph again.
+PAGE_CACHE_RETRY = int(os.environ.get("PAGE_CACHE_RETRY", 60))
+# Only one process refreshes an entry at a time, this is the maximum time it may take.
+REFRESH_LOCK_TIMEOUT = 30
+
+PREFIX = "cache:page:"
+STATS_KEY = "cache:stats"
+
+
+def getPageInfo(pageID):
+    """ Returns dict with name, profilePic and cover of the page or None if the page does not exist. """
+    key = PREFIX + str(pageID)
+    raw = conn.get(key)
+    if raw is None:
+        countStat("miss")
+        return fetchPageInfo(pageID)
+
+    entry = json.loads(raw.decode("utf-8"))
+    if time.time() - entry["fetched"] > PAGE_CACHE_TTL:
+        countStat("stale")
+        refreshInBackground(pageID)
+    else:
+        countStat("hit")
+    return entry["info"]
+
+
+@job(BACKGROUND, connection=conn)
+@sessionScope
+def refreshPageInfo(pageID):
+    """ Fetch page info from database and Graph API and store it in the cache. """
+    try:
+        return fetchPageInfo(pageID)
+    finally:
+        conn.delete(lockKey(pageID))
+
+
+def fetchPageInfo(pageID):
+    page = Page.findById(pageID)
+    if not page:
+        return None
+
+    fbPage = FBPage(page)
+    info = {
+        "name": page.name,
+        "profilePic": fbPage.getProfilePictureUrl(),
+        "cover": fbPage.getCoverPictureUrl(),
+    }
+    entry = {
+        "fetched": time.time(),
+        "info": info,
+    }
+    key = PREFIX + str(pageID)
+    if info["profilePic"] is not None:
+        conn.set(key, json.dumps(entry), ex=PAGE_CACHE_TTL + PAGE_CACHE_STALE)
+    else:
+        # every page has a profile picture, so Graph failed: keep serving the previous entry if there is one
+        log("Failed to fetch page info of {}, retrying in {}s", pageID, PAGE_CACHE_RETRY)
+        conn.set(key, json.dumps(entry), ex=PAGE_CACHE_RETRY, nx=True)
+    return info
+
+
+def refreshInBackground(pageID):
+    """ Refresh a stale entry in the worker, unless a refresh is already underway. """
+    if conn.set(lockKey(pageID), 1, ex=REFRESH_LOCK_TIMEOUT, nx=True):
+        refreshPageInfo.delay(pageID)
+
+
+def lockKey(pageID):
+    return PREFIX + str(pageID) + ":refreshing"
+
+
+def invalidatePage(pageID):
+    conn.delete(PREFIX + str(pageID))
+
+
+def countStat(name):
+    conn.hincrby(STATS_KEY, name, 1)
+
+
+def stats():
+    """ Returns the hit, stale and miss counters shared by all processes. """
+    raw = conn.hgetall(STATS_KEY)
+    counters = {"hit": 0, "stale": 0, "miss": 0}
+    counters.update({key.decode("utf-8"): int(value) for key, value in raw.items()})
+    return counters
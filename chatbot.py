@@ -1,23 +1,48 @@
+import time
+import inspect
 from urllib.parse import urljoin
 
 from message import *
 from database import *
 import facebook
+import cache
+import pageQueue
+import reindex
+from worker import conn, BULK
 from flask import url_for
+from rq.decorators import job
 
 
-URL = os.environ["URL"]
 ADMIN_SENDER_ID = os.environ.get("ADMIN_SENDER_ID")
 DISABLED = os.environ.get("DISABLED", 0) == '1'
 MAX_MESSAGE_LENGTH = 600
+DIGEST_THRESHOLD = int(os.environ.get("DIGEST_THRESHOLD", 3))     # more pending confessions are sent as a digest
+DIGEST_TEXT_LENGTH = 80     # Facebook limits titles and subtitles of generic template elements to 80 chars
+POSTBACK_STATS_KEY = "postback:stats"
 
 
 class Chatbot:
+    postbacks = dict()      # action code -> Postback, built when the class is created
+    postbackNames = dict()
+
     def __init__(self):
         pass
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        postbacks = dict(cls.postbacks)
+        for name, attribute in vars(cls).items():
+            if not isinstance(attribute, Postback):
+                continue
+            registered = postbacks.get(attribute.code)
+            if registered and registered.name != name:
+                raise RuntimeError("Postbacks '{}' and '{}' both use code '{}'.".format(registered.name, name, attribute.code))
+            postbacks[attribute.code] = attribute
+        cls.postbacks = postbacks
+        cls.postbackNames = {pb.name: pb for pb in postbacks.values()}
+
     def receivedMessage(self, sender, recipient, message):
-        log("Received message \"{}\" from {}".format(message, sender))
+        log("Received message \"{}\" from {}", message, sender)
         if sender == ADMIN_SENDER_ID:
             if self.adminMessage(sender, message):
                 return
@@ -36,25 +61,47 @@ class Chatbot:
         pass
 
     def receivedPostback(self, sender, recipient, payload):
-        log("Received postback with payload \"{}\" from {}".format(payload, sender))
+        log("Received postback with payload \"{}\" from {}", payload, sender)
 
         if DISABLED:
             response = TextMessage("I am temporarily offline. Follow the page for updates!")
             response.send(sender)
             return
 
-        data = json.loads(payload)
-        type = data.get("type")
-        if not type:
-            raise RuntimeError("No 'type' included in postback.")
+        pb, args = self.decodePostback(payload)
+        if pb is None:
+            warning("Ignoring postback with unknown payload \"{}\" from {}", payload, sender)
+            return
 
-        if type == "action":
-            action = data["action"]
-            pb = self.__getattribute__(action)
-            args = data.get("args", dict())
-            if not pb:
-                raise RuntimeError("No postback for action '{}'.".format(action))
+        start = time.time()
+        failed = True
+        try:
             pb.func(self, sender, **args)
+            failed = False
+        finally:
+            recordPostback(pb.name, time.time() - start, failed)
+
+    def decodePostback(self, payload):
+        """ Returns (postback, args) for the payload, (None, None) if it is not a known action. """
+        if payload.startswith("{"):     # verbose JSON payloads sent before action codes existed
+            try:
+                data = json.loads(payload)
+            except ValueError:
+                return None, None
+            if data.get("type") != "action":
+                return None, None
+            pb = self.postbackNames.get(data.get("action"))
+            args = data.get("args", dict())
+            if pb is None or not isinstance(args, dict) or not set(args) <= set(pb.params):
+                return None, None
+            return pb, args
+
+        code, _, encoded = payload.partition(":")
+        pb = self.postbacks.get(code)
+        args = pb.decode(encoded) if pb else None
+        if args is None:
+            return None, None
+        return pb, args
 
     def adminMessage(self, sender, message):
         # TODO: create @command decorator
@@ -64,40 +111,96 @@ class Chatbot:
         return False
 
     def runSetup(self, sender, message):
+        import profile     # profile imports this module for the postback payloads
+
         response = TextMessage("Running setup")
         response.send(sender)
         profile.setup()
         return True
 
 
-class postback:
-    def __init__(self, func):
+def recordPostback(name, duration, failed):
+    """ Count and time postbacks in Redis, every job runs in its own forked process. """
+    try:
+        pipe = conn.pipeline(transaction=False)
+        pipe.hincrby(POSTBACK_STATS_KEY, name + ":count", 1)
+        pipe.hincrbyfloat(POSTBACK_STATS_KEY, name + ":time", duration)
+        if failed:
+            pipe.hincrby(POSTBACK_STATS_KEY, name + ":errors", 1)
+        pipe.execute()
+    except Exception as e:
+        log("Failed to record postback stats: {}", e)
+
+
+def postbackStats():
+    """ Returns per action count, errors and mean duration in seconds. """
+    stats = dict()
+    for field, value in conn.hgetall(POSTBACK_STATS_KEY).items():
+        name, _, stat = field.decode("utf-8").rpartition(":")
+        stats.setdefault(name, {"count": 0, "errors": 0, "time": 0.0})[stat] = float(value)
+    for stat in stats.values():
+        stat["mean"] = stat.pop("time") / stat["count"] if stat["count"] else 0.0
+    return stats
+
+
+def postback(code):
+    """ Decorator for actions behind buttons. Button payloads are the action code followed by the arguments
+        as a compact JSON list, e.g. 'a:[42]'. Codes end up in buttons that were already sent, so they must never change. """
+    if ":" in code or code.startswith("{"):
+        raise RuntimeError("Invalid postback code '{}'.".format(code))
+
+    def register(func):
+        return Postback(code, func)
+    return register
+
+
+class Postback:
+    def __init__(self, code, func):
+        self.code = code
         self.func = func
-
-    def __call__(self, *args, **kwargs):
-        action = self.func.__name__
-        payload = {
-            "type": "action",
-            "action": action,
-        }
-        if len(kwargs) > 0:
-            payload["args"] = kwargs
-        return payload
+        self.name = func.__name__
+        self.params = list(inspect.signature(func).parameters)[2:]     # skip self and sender
+
+    def __call__(self, **kwargs):
+        """ Returns the payload for a button. """
+        return self.encode(kwargs)
+
+    def encode(self, kwargs):
+        unknown = set(kwargs) - set(self.params)
+        if unknown:
+            raise RuntimeError("Unknown arguments {} for postback '{}'.".format(", ".join(sorted(unknown)), self.name))
+        values = [kwargs.get(param) for param in self.params]
+        while values and values[-1] is None:
+            values.pop()
+        if not values:
+            return self.code
+        return self.code + ":" + json.dumps(values, separators=(",", ":"))
+
+    def decode(self, encoded):
+        if not encoded:
+            return dict()
+        try:
+            values = json.loads(encoded)
+        except ValueError:
+            return None
+        if not isinstance(values, list) or len(values) > len(self.params):
+            return None
+        return dict(zip(self.params, values))
 
 
 class ConfessionsBot(Chatbot):
     def onMessage(self, sender, message):
         pass
 
-    @postback
+    @postback("w")
     def sendWelcome(self, sender):
         raise NotImplementedError
 
-    @postback
+    @postback("l")
     def listPages(self, sender):
         raise NotImplementedError
 
-    @postback
+    @postback("p")
     def sendPending(self, sender):
         raise NotImplementedError
 
@@ -106,23 +209,23 @@ class ConfessionsVoterBot(ConfessionsBot):
     def onMessage(self, sender, message):
         super().onMessage(sender, message)
 
-    @postback
+    @postback("w")
     def sendWelcome(self, sender):
         pass
 
-    @postback
+    @postback("l")
     def listPages(self, sender):
         pass
 
-    @postback
+    @postback("a")
     def acceptConfession(self, sender, confessionID=None):
         pass
 
-    @postback
+    @postback("r")
     def rejectConfession(self, sender, confessionID=None):
         pass
 
-    @postback
+    @postback("p")
     def sendPending(self, sender):
         pass
 
@@ -144,7 +247,7 @@ class ConfessionsAdminBot(ConfessionsBot):
 
         clientToken = facebook.getClientTokenFromCode(sender, code)
         if clientToken:
-            debug("Client Token: " + str(clientToken))
+            debug("Client Token: {}", clientToken)
             status = self.actualListPages(sender, clientToken)
             if status:
                 return
@@ -171,8 +274,9 @@ class ConfessionsAdminBot(ConfessionsBot):
             message = TextMessage("Couldn't find any pages that you manage.")
             message.send(sender)
         else:
+            batch = MessageBatch()
             message = TextMessage("Found these pages. Select which ones you want me to help manage.")
-            message.send(sender)
+            batch.add(message, sender)
 
             # group pages by 10
             pageBatch = 10
@@ -188,7 +292,11 @@ class ConfessionsAdminBot(ConfessionsBot):
                     element = Element(name, "", url, imageURL)
                     element.addButton("Manage", self.managePage(pageID=pageID, name=name, token=token))
                     pagesMessage.addElement(element)
-                pagesMessage.send(sender)
+                batch.add(pagesMessage, sender)
+
+            statuses = batch.send()
+            if not all(statuses):
+                log("Failed to send {} of {} messages listing pages", statuses.count(False), len(statuses))
 
         return True
 
@@ -196,14 +304,12 @@ class ConfessionsAdminBot(ConfessionsBot):
         admin = confession.page.admin_messenger_id
         text = "[{}]\n{}\n\"{}\"".format(confession.page.name, confession.timestamp.strftime("%Y-%m-%d %H:%M"), confession.text)
 
+        batch = MessageBatch()
         index = 0
         if len(text) > MAX_MESSAGE_LENGTH:     # Facebook limits messages to 640 chars, we take 600 to be sure
             while index < len(text) - MAX_MESSAGE_LENGTH:
                 subset = text[index:index+MAX_MESSAGE_LENGTH]
-                message = TextMessage(subset)
-                status = message.send(admin)
-                if not status:
-                    raise RuntimeError("Failed to send first parts of long confession to admin")
+                batch.add(TextMessage(subset), admin)
                 index += MAX_MESSAGE_LENGTH
 
         subset = text[index:]
@@ -216,13 +322,18 @@ class ConfessionsAdminBot(ConfessionsBot):
 
         message.addButton("Post", self.acceptConfession(confessionID=confession.id))
         message.addButton("Discard", self.rejectConfession(confessionID=confession.id))
-        status = message.send(admin)
-        if status:
-            confession.setPending()
-            confession.save()
-        else:
+        batch.add(message, admin)
+
+        statuses = batch.send()
+        if all(statuses):
+            if confession.status != "pending":
+                confession.setPending()
+                confession.save()
+        elif all(statuses[:-1]):
             raise RuntimeError("Failed to send confession to admin.")
-        return status
+        else:
+            raise RuntimeError("Failed to send part {} of {} of long confession to admin".format(statuses.index(False) + 1, len(statuses)))
+        return True
 
     def sendFreshConfession(self, page):
         fresh = page.getFirstFreshConfession()
@@ -238,18 +349,18 @@ class ConfessionsAdminBot(ConfessionsBot):
     #   Postbacks   #
     #################
 
-    @postback
+    @postback("w")
     def sendWelcome(self, sender):
         message = TextMessage("Hello! I'm glad you decided to use this app.")
         message.send(sender)
         self.sendLogin(sender)
 
-    @postback
+    @postback("l")
     def listPages(self, sender):
         """ Doesn't actually list pages. Need permission first. (See actualListPages) """
         self.sendLogin(sender)
 
-    @postback
+    @postback("m")
     def managePage(self, sender, pageID=None, name=None, token=None):
         page = Page.findById(pageID)
         if page:
@@ -266,11 +377,12 @@ class ConfessionsAdminBot(ConfessionsBot):
 
         page.token = token
         page.save()
+        cache.invalidatePage(pageID)
 
         message = TextMessage("Confessions need to be submitted to: " + str(url_for("confession_form", pageID=pageID, _external=True)))
         message.send(sender)
 
-    @postback
+    @postback("a")
     def acceptConfession(self, sender, confessionID=None):
         confession = Confession.findById(confessionID)
         if confession.status == "posted":
@@ -293,7 +405,7 @@ class ConfessionsAdminBot(ConfessionsBot):
         if not confession.page.hasPendingConfession():
             self.sendFreshConfession(confession.page)
 
-    @postback
+    @postback("r")
     def rejectConfession(self, sender, confessionID=None):
         confession = Confession.findById(confessionID)
         if confession.status != "pending":
@@ -306,36 +418,96 @@ class ConfessionsAdminBot(ConfessionsBot):
         if not confession.page.hasPendingConfession():
             self.sendFreshConfession(confession.page)
 
-    @postback
-    def sendPending(self, sender):
+    @postback("p")
+    def sendPending(self, sender, digest=None):
+        """ Resend pending confessions, as a compact digest when there are more than DIGEST_THRESHOLD. """
         pendingConfessions = Confession.getPending(sender)
         if len(pendingConfessions) == 0:
             message = TextMessage("No pending confessions.")
             message.send(sender)
+        elif digest or (digest is None and len(pendingConfessions) > DIGEST_THRESHOLD):
+            self.sendPendingDigest(sender, pendingConfessions)
         else:
             for pending in pendingConfessions:
                 self.sendConfession(pending)
 
+    def sendPendingDigest(self, sender, confessions):
+        batch = MessageBatch()
+        batch.add(TextMessage("{} pending confessions:".format(len(confessions))), sender)
+
+        # carousels hold 10 elements
+        for start in range(0, len(confessions), 10):
+            digest = GenericMessage()
+            for confession in confessions[start:start+10]:
+                title = "[{}] {}".format(confession.page.name, confession.timestamp.strftime("%Y-%m-%d %H:%M"))
+                referencedConfession = confession.getReferencedConfession()
+                if referencedConfession:
+                    title += " re #{}".format(referencedConfession.index)
+                text = confession.text
+                if len(text) > DIGEST_TEXT_LENGTH:
+                    text = text[:DIGEST_TEXT_LENGTH - 3] + "..."
+                element = Element(title[:DIGEST_TEXT_LENGTH], text)
+                if len(confession.text) > DIGEST_TEXT_LENGTH or referencedConfession:
+                    element.addButton("Read", self.showConfession(confessionID=confession.id))
+                element.addButton("Post", self.acceptConfession(confessionID=confession.id))
+                element.addButton("Discard", self.rejectConfession(confessionID=confession.id))
+                digest.addElement(element)
+            batch.add(digest, sender)
+
+        statuses = batch.send()
+        if not all(statuses):
+            raise RuntimeError("Failed to send part {} of {} of pending digest to admin".format(statuses.index(False) + 1, len(statuses)))
+
+    @postback("s")
+    def showConfession(self, sender, confessionID=None):
+        """ Send the full confession from the digest. """
+        confession = Confession.findById(confessionID)
+        if confession is None or confession.status != "pending":
+            message = TextMessage("Already handled that confession")
+            message.send(sender)
+            return
+        self.sendConfession(confession)
+
     def adminMessage(self, sender, message):
         if super().adminMessage(sender, message):
             return True
-        elif message == "indexConfessions":
+        elif message in ("indexConfessions", "indexConfessions restart"):
             return self.indexConfessions(sender, message)
+        elif message == "rebuildQueues":
+            return self.rebuildQueues(sender, message)
+        elif message == "postbackStats":
+            return self.sendPostbackStats(sender, message)
 
         return False
 
     def indexConfessions(self, sender, message):
+        """ Runs as a separate job, it continues where it stopped unless restarted. """
+        reindex.reindexConfessions.delay(sender, restart=message.endswith("restart"))
         response = TextMessage("Indexing confessions")
         response.send(sender)
-        for confession in Confession.findByStatus("posted"):
-            post = facebook.FBPost(confession.fb_id,
-                                   token=confession.page.token)  # do not give confessions text, it will be fetched (with index)
-            index = post.getIndex()
-            if index:
-                confession.index = index
-                confession.save()
         return True
 
+    def rebuildQueues(self, sender, message):
+        """ Runs as a separate job on the bulk queue. """
+        rebuildPageQueues.delay(sender)
+        response = TextMessage("Rebuilding moderation queues")
+        response.send(sender)
+        return True
+
+    def sendPostbackStats(self, sender, message):
+        stats = sorted(postbackStats().items(), key=lambda item: item[1]["mean"], reverse=True)
+        lines = ["{}: {:.0f}x, {:.2f}s avg, {:.0f} failed".format(name, stat["count"], stat["mean"], stat["errors"]) for name, stat in stats]
+        response = TextMessage("Postbacks\n" + ("\n".join(lines) or "none yet"))
+        response.send(sender)
+        return True
 
-import profile
 
+@job(BULK, connection=conn)
+@sessionScope
+def rebuildPageQueues(admin):
+    Page.rebuildQueues()
+    lines = list()
+    for page in Page.getAll():
+        lines.append("{}: {} fresh, {} pending".format(page.name, pageQueue.depth(page.fb_id), pageQueue.pendingCount(page.fb_id)))
+    response = TextMessage("Rebuilt moderation queues\n" + "\n".join(lines))
+    response.send(admin)
@@ -1,26 +1,129 @@
+import os
+import time
+import json
+import pickle
+import datetime
 import itertools
 import numpy as np
 
-from sklearn.feature_extraction.text import CountVectorizer
+from sklearn.feature_extraction.text import CountVectorizer, HashingVectorizer, TfidfVectorizer
 from sklearn.model_selection import StratifiedKFold, cross_val_predict
-from sklearn.metrics import confusion_matrix
+from sklearn.metrics import confusion_matrix, precision_recall_fscore_support, accuracy_score
 from sklearn.pipeline import Pipeline
 from sklearn.naive_bayes import MultinomialNB
+from sklearn.linear_model import LogisticRegression
 from sklearn.externals import joblib
 
 import bacli
 
-from dataSource import getTrainData, getFreshData, CLASSES
+from concurrent.futures import ProcessPoolExecutor
 
+from dataSource import getTrainData, getFreshData, iterTrainBatches, iterFreshBatches, countLabeledByPage, CLASSES, POSTED
+import modelRegistry
+
+import matplotlib
+matplotlib.use('Agg')   # plots are written to files, no display needed
 import matplotlib.pyplot as plt
 
 
 bacli.setDescription("Data mining tools for Confessions")
 
 
+# Pages with less labeled confessions are scored by the shared model, trained on all pages.
+MIN_PAGE_SAMPLES = 500
+
+
+@bacli.command
+def train(streaming: int=0, promote: int=1, minSamples: int=MIN_PAGE_SAMPLES, processes: int=0):
+    """
+    Train and store the shared model and a model for every page with at least minSamples labeled confessions,
+    in parallel processes (0 for one per core). With streaming 1, memory use does not depend on the amount of confessions.
+    """
+    from database import Session, disposeEngine
+
+    counts = countLabeledByPage()
+    pages = sorted(pageID for pageID, count in counts.items() if count >= minSamples)
+    print("Training shared model on {} confessions and {} page models".format(sum(counts.values()), len(pages)))
+
+    # child processes must open their own database connections
+    Session.remove()
+    disposeEngine()
+
+    names = [modelRegistry.SHARED] + pages
+    results = list()
+    failed = list()
+    with ProcessPoolExecutor(max_workers=processes or None) as executor:
+        futures = [(name, executor.submit(trainModel, name, streaming, promote)) for name in names]
+        for name, future in futures:
+            # e.g. a page with too few confessions of a class for cross validation, the others still count
+            try:
+                results.append(future.result())
+            except Exception as e:
+                print("{}\tfailed: {!r}".format(name, e))
+                failed.append(name)
+
+    for name, version, samples, accuracy in results:
+        print("{}\t{}\t{} samples\taccuracy {:.3f}".format(name, version, samples, accuracy))
+    if promote:
+        # pages without a new model are scored by the shared one
+        modelRegistry.writeIndex([pageID for pageID in pages if pageID not in failed])
+    if failed:
+        print("Training failed for {} of {} models: {}".format(len(failed), len(names), ", ".join(failed)))
+
+
+def trainModel(name, streaming, promote):
+    """ Train and store one model, runs in a child process. Returns (name, version, samples, accuracy). """
+    pageID = None if name == modelRegistry.SHARED else name
+    plotFile = "confusion_matrix_{}.png".format(name)
+    if streaming:
+        pipeline, conf_mat, samples = trainStreaming(pageID, plotFile)
+    else:
+        pipeline, conf_mat, samples = trainInMemory(pageID, plotFile)
+
+    meta = {
+        "trained": datetime.datetime.now().isoformat(),
+        "page": pageID,
+        "streaming": bool(streaming),
+        "samples": samples,
+        "metrics": confusionMetrics(conf_mat),
+    }
+    version = modelRegistry.save(pipeline, meta, name)
+    if promote:
+        modelRegistry.promote(version, name)
+    return name, version, samples, meta["metrics"]["accuracy"]
+
+
+@bacli.command
+def promote(version: str, name: str=modelRegistry.SHARED):
+    """ Make a stored model version the one used for scoring. """
+    modelRegistry.promote(version, name)
+
+
 @bacli.command
-def train():
-    """ Train and store classifier. """
+def models(name: str=modelRegistry.SHARED):
+    """ List stored model versions with their metrics. """
+    current = modelRegistry.currentVersion(name)
+    for version in modelRegistry.listVersions(name):
+        meta = modelRegistry.getMeta(version, name)
+        marker = "*" if version == current else " "
+        print("{} {}\t{} samples\taccuracy {:.3f}".format(marker, version, meta["samples"], meta["metrics"]["accuracy"]))
+
+
+def confusionMetrics(conf_mat):
+    """ Accuracy and per class precision and recall from a confusion matrix with CLASSES as labels. """
+    total = conf_mat.sum()
+    metrics = {"accuracy": float(np.trace(conf_mat) / total) if total else 0.0}
+    for i, label in enumerate(CLASSES):
+        predicted = conf_mat[:, i].sum()
+        actual = conf_mat[i, :].sum()
+        metrics[label] = {
+            "precision": float(conf_mat[i, i] / predicted) if predicted else 0.0,
+            "recall": float(conf_mat[i, i] / actual) if actual else 0.0,
+        }
+    return metrics
+
+
+def trainInMemory(pageID=None, plotFile="confusion_matrix.png"):
     vectorizer = CountVectorizer(ngram_range=(1, 2),
                                  stop_words='english',
                                  strip_accents='unicode'
@@ -33,48 +136,243 @@ def train():
         ('classifier', classifier)
     ])
 
-    data = getTrainData()
+    data = getTrainData(pageID)
     x = data['text'].values
     y = data['class'].values
 
-    y_pred = cv(x, y, pipeline)
-    conf_mat = confusion_matrix(y, y_pred)
+    y_pred = cv(x, y, pipeline, n_jobs=1)   # already runs in one of the training processes
+    conf_mat = confusion_matrix(y, y_pred, labels=CLASSES)
 
     print('Total confessions classified:', len(data))
-    plot_confusion_matrix(conf_mat, CLASSES)
+    plot_confusion_matrix(conf_mat, CLASSES, outFile=plotFile)
 
     pipeline.fit(x, y)
-    joblib.dump(pipeline, "model.pkl")
+    return pipeline, conf_mat, len(data)
+
+
+def trainStreaming(pageID=None, plotFile="confusion_matrix.png"):
+    """ Learn from batches with a stateless vectorizer, each batch is evaluated before the model learns from it. """
+    vectorizer = HashingVectorizer(ngram_range=(1, 2),
+                                   stop_words='english',
+                                   strip_accents='unicode',
+                                   alternate_sign=False,    # MultinomialNB needs non-negative features
+                                   n_features=2 ** 20
+                                   )
+
+    classifier = MultinomialNB()
+
+    conf_mat = np.zeros((len(CLASSES), len(CLASSES)), dtype=int)
+    total = 0
+    for texts, labels in iterTrainBatches(pageID):
+        x = vectorizer.transform(texts)
+        if total > 0:
+            conf_mat += confusion_matrix(labels, classifier.predict(x), labels=CLASSES)
+        classifier.partial_fit(x, labels, classes=CLASSES)
+        total += len(texts)
+        print("Trained on {} confessions".format(total))
+
+    print('Total confessions classified:', total)
+    plot_confusion_matrix(conf_mat, CLASSES, outFile=plotFile)
+
+    pipeline = Pipeline([
+        ('vectorizer', vectorizer),
+        ('classifier', classifier)
+    ])
+    return pipeline, conf_mat, total
+
+
+def textFeatures(kind, ngrams):
+    options = dict(ngram_range=(1, ngrams), stop_words='english', strip_accents='unicode')
+    if kind == "count":
+        return CountVectorizer(**options)
+    if kind == "tfidf":
+        return TfidfVectorizer(**options)
+    if kind == "hash":
+        return HashingVectorizer(alternate_sign=False, n_features=2 ** 20, **options)
+    raise RuntimeError("Unknown vectorizer: " + str(kind))
+
+
+# Model variants that can be evaluated, by name. "nb-count-2" is the one used by train.
+VARIANTS = {
+    "nb-count-1": lambda: (textFeatures("count", 1), MultinomialNB()),
+    "nb-count-2": lambda: (textFeatures("count", 2), MultinomialNB()),
+    "nb-tfidf-2": lambda: (textFeatures("tfidf", 2), MultinomialNB()),
+    "nb-hash-2": lambda: (textFeatures("hash", 2), MultinomialNB()),
+    "logreg-tfidf-2": lambda: (textFeatures("tfidf", 2), LogisticRegression()),
+}
 
 
 @bacli.command
-def run(modelFile='model.pkl'):
-    """ Load classifier and classify fresh. """
-    pipeline = joblib.load(modelFile)
+def evaluate(variants: str="all", folds: int=8, report: str="report.json", plots: str="plots", pageID: str=""):
+    """ Benchmark model variants (comma separated names or all) with stratified k-fold, writes a json report and plots. """
+    names = sorted(VARIANTS) if variants == "all" else variants.split(",")
+    for name in names:
+        if name not in VARIANTS:
+            raise RuntimeError("Unknown variant '{}', choose from: {}".format(name, ", ".join(sorted(VARIANTS))))
+
+    data = getTrainData(pageID or None)
+    x = data['text'].values
+    y = data['class'].values
+    os.makedirs(plots, exist_ok=True)
+
+    results = dict()
+    for name in names:
+        print("Evaluating", name)
+        result, conf_mat = evaluateVariant(name, x, y, folds)
+        plot_confusion_matrix(conf_mat, CLASSES, title=name, outFile=os.path.join(plots, name + ".png"))
+        results[name] = result
+
+    plotBenchmark(results, os.path.join(plots, "benchmark.png"))
+    output = {
+        "date": datetime.datetime.now().isoformat(),
+        "samples": len(y),
+        "folds": folds,
+        "variants": results,
+    }
+    with open(report, "w") as f:
+        json.dump(output, f, indent=2)
+    print("Report written to", report)
+
+
+def evaluateVariant(name, x, y, folds):
+    """ Returns dict with quality and speed metrics and the confusion matrix over all folds. """
+    k_fold = StratifiedKFold(shuffle=True, n_splits=folds, random_state=0)
+    y_pred = np.empty(len(y), dtype=y.dtype)
+    fitTimes = list()
+    predictTime = 0.0
+    for trainIndex, testIndex in k_fold.split(x, y):
+        vectorizer, classifier = VARIANTS[name]()
+        pipeline = Pipeline([
+            ('vectorizer', vectorizer),
+            ('classifier', classifier)
+        ])
+
+        start = time.perf_counter()
+        pipeline.fit(x[trainIndex], y[trainIndex])
+        fitTimes.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        y_pred[testIndex] = pipeline.predict(x[testIndex])
+        predictTime += time.perf_counter() - start
+
+    precision, recall, f1, support = precision_recall_fscore_support(y, y_pred, labels=CLASSES)
+    result = {
+        "accuracy": float(accuracy_score(y, y_pred)),
+        "classes": {
+            label: {
+                "precision": float(precision[i]),
+                "recall": float(recall[i]),
+                "f1": float(f1[i]),
+                "support": int(support[i]),
+            } for i, label in enumerate(CLASSES)
+        },
+        "fit_seconds": float(np.mean(fitTimes)),
+        "predict_docs_per_second": len(y) / predictTime if predictTime > 0 else None,
+        "model_bytes": len(pickle.dumps(pipeline)),     # model of the last fold
+    }
+    return result, confusion_matrix(y, y_pred, labels=CLASSES)
+
+
+def plotBenchmark(results, outFile):
+    """ Quality against prediction speed of all variants. """
+    plt.figure()
+    for name, result in results.items():
+        f1 = np.mean([metrics["f1"] for metrics in result["classes"].values()])
+        plt.scatter(result["predict_docs_per_second"] or 0, f1)
+        plt.annotate(name, (result["predict_docs_per_second"] or 0, f1))
+    plt.xscale('log')
+    plt.xlabel('Predicted docs/sec')
+    plt.ylabel('Mean F1')
+    plt.title('Model variants')
+    plt.tight_layout()
+    plt.savefig(outFile)
+    plt.close()
+
+
+@bacli.command
+def run(modelFile=''):
+    """ Load classifier (current one from the registry by default) and classify fresh. """
+    if modelFile:
+        pipeline = joblib.load(modelFile)
+    else:
+        pipeline, version = modelRegistry.getModel()
+        if pipeline is None:
+            print("No model was promoted yet")
+            return
 
     data = getFreshData()
     if len(data) == 0:
         print("No fresh confessions")
         return
     x = data['text'].values
-    y = pipeline.predict_proba(x)
+    labels, confidences, _ = predictBatch(pipeline, x)
 
-    for sample, scores in zip(x, y):
+    for sample, label, score in zip(x, labels, confidences):
         print(sample)
-        label, score = getBestLabelScore(scores)
         print("{:.2f}\t{}".format(score*100, label))
 
 
-def getBestLabelScore(scores):
-    bestIndex = max(enumerate(scores), key=lambda x: x[1])[0]
-    return CLASSES[bestIndex], scores[bestIndex]
-
-
-def cv(x, y, classifier):
+@bacli.command
+def score(batchSize: int=1000, pageID: str=""):
+    """ Score the fresh backlog with the current model of each page and store the scores, one UPDATE per batch. """
+    from database import Confession, Page
+
+    start = time.perf_counter()
+    total = 0
+    counts = dict()
+    pages = set()
+    for ids, pageIDs, texts in iterFreshBatches(pageID or None, batchSize):
+        ids = np.asarray(ids)
+        pageIDs = np.asarray(pageIDs)
+        texts = np.asarray(texts, dtype=object)
+        scores = np.empty(len(ids))
+        versions = np.empty(len(ids), dtype=object)
+
+        for page in np.unique(pageIDs):
+            pipeline, version = modelRegistry.getModelForPage(page)
+            if pipeline is None:
+                print("No model for page", page)
+                continue
+            mask = pageIDs == page
+            labels, confidences, pageScores = predictBatch(pipeline, texts[mask])
+            scores[mask] = pageScores
+            versions[mask] = version
+            for label, count in zip(*np.unique(labels, return_counts=True)):
+                counts[label] = counts.get(label, 0) + int(count)
+
+        scored = np.array([version is not None for version in versions], dtype=bool)
+        Confession.bulkSetScores(ids[scored].tolist(), scores[scored].tolist(), versions[scored].tolist())
+        pages.update(pageIDs[scored].tolist())
+        total += int(scored.sum())
+        elapsed = time.perf_counter() - start
+        print("Scored {} confessions, {:.0f} rows/sec".format(total, total / elapsed))
+
+    # the scores were written around the session, the queues have to be reloaded for the new order
+    for page in pages:
+        Page.rebuildQueue(page)
+
+    elapsed = time.perf_counter() - start
+    print("Scored {} confessions in {:.1f}s ({:.0f} rows/sec)".format(total, elapsed, total / elapsed if elapsed else 0))
+    for label, count in counts.items():
+        print("{}\t{}".format(label, count))
+
+
+def predictBatch(pipeline, texts):
+    """ Returns arrays with the best label, its probability and the probability of being posted for every text. """
+    proba = pipeline.predict_proba(texts)
+    classes = np.asarray(pipeline.classes_)
+    best = proba.argmax(axis=1)
+    labels = classes[best]
+    confidences = proba[np.arange(len(best)), best]
+    posted = proba[:, np.flatnonzero(classes == POSTED)[0]]
+    return labels, confidences, posted
+
+
+def cv(x, y, classifier, n_jobs=-1):
     """ Get labels of all samples using StratifiedKFold cross validation. """
     print("Cross validating")
     k_fold = StratifiedKFold(shuffle=True, n_splits=8)
-    y_pred = cross_val_predict(classifier, x, y, cv=k_fold, n_jobs=-1)
+    y_pred = cross_val_predict(classifier, x, y, cv=k_fold, n_jobs=n_jobs)
 
     return y_pred
 
@@ -88,8 +386,8 @@ def cv_score(x, y, classifier):
     return y_pred
 
 
-def plot_confusion_matrix(cm, p_labels=None, title='Confusion matrix', cmap=plt.cm.Blues):
-    """ This function prints and plots the confusion matrix. """
+def plot_confusion_matrix(cm, p_labels=None, title='Confusion matrix', cmap=plt.cm.Blues, outFile='confusion_matrix.png'):
+    """ This function prints the confusion matrix and plots it to outFile. """
 
     print('Confusion matrix, without normalization')
     print(cm)
@@ -111,6 +409,7 @@ def plot_confusion_matrix(cm, p_labels=None, title='Confusion matrix', cmap=plt.
     plt.tight_layout()
     plt.ylabel('True label')
     plt.xlabel('Predicted label')
-    plt.show()
+    plt.savefig(outFile)
+    plt.close()
 
 
@@ -0,0 +1,32 @@
+import os
+import functools
+
+# Required settings are read when they are first used, so importing a module never fails because one is missing.
+
+
+@functools.lru_cache(maxsize=None)
+def require(name):
+    value = os.environ.get(name)
+    if value is None:
+        raise RuntimeError("Environment variable {} is not set.".format(name))
+    return value
+
+
+def pageAccessToken():
+    return require("PAGE_ACCESS_TOKEN")
+
+
+def appID():
+    return require("APP_ID")
+
+
+def clientSecret():
+    return require("CLIENT_SECRET")
+
+
+def verifyToken():
+    return require("VERIFY_TOKEN")
+
+
+def databaseUrl():
+    return require("DATABASE_URL")
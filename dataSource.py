@@ -1,5 +1,5 @@
-from pandas import DataFrame
-from database import Confession
+from sqlalchemy.sql import func
+from database import Confession, Session
 
 
 # labels for classification
@@ -9,36 +9,67 @@ REJECTED = 'rejected'
 CLASSES = [POSTED, REJECTED]
 
 FRESH = 'fresh'
-PAGE_ID = '595906520554969'
 
+CHUNK_SIZE = 1000
 
-def build_data_frame(confessions, classification=None):
-    """ Create pandas data frame from file and class. """
-    rows = []
-    for confession in confessions:
-        data = {'text': confession.text}
-        if classification:
-            data['class'] = classification
-        rows.append(data)
 
-    data_frame = DataFrame(rows)
-    return data_frame
+def labeledQuery(pageID=None):
+    """ Query for (text, class) of labeled confessions of a page, or all pages, without loading full objects. """
+    query = Session.query(Confession.text, Confession.status).filter(Confession.status.in_(CLASSES))
+    if pageID:
+        query = query.filter(Confession.page_id == pageID)
+    return query
 
 
-def getTrainData():
-    data = DataFrame({'text': [], 'class': []})
-    for label in CLASSES:
-        confessions = Confession.findByStatusAndPage(label, PAGE_ID)
-        # confessions = Confession.findByStatus(label)
-        data = data.append(build_data_frame(confessions, label))
+def countLabeledByPage():
+    """ Returns dict from page id to its amount of labeled confessions. """
+    query = Session.query(Confession.page_id, func.count(Confession.id))
+    query = query.filter(Confession.status.in_(CLASSES)).group_by(Confession.page_id)
+    return dict(query.all())
 
-    return data
 
+def getTrainData(pageID=None):
+    from pandas import DataFrame
+    rows = labeledQuery(pageID).all()
+    return DataFrame.from_records(rows, columns=['text', 'class'])
 
-def getFreshData():
-    data = DataFrame({'text': []})
-    confessions = Confession.findByStatusAndPage(FRESH, PAGE_ID)
-    # confessions = Confession.findByStatus(FRESH)
-    data = data.append(build_data_frame(confessions))
-    return data
 
+def getFreshData(pageID=None):
+    from pandas import DataFrame
+    query = Session.query(Confession.text).filter(Confession.status == FRESH)
+    if pageID:
+        query = query.filter(Confession.page_id == pageID)
+    return DataFrame.from_records(query.all(), columns=['text'])
+
+
+def iterTrainBatches(pageID=None, chunkSize=CHUNK_SIZE):
+    """ Yields (texts, classes) batches of labeled confessions, read with a server-side cursor. """
+    query = labeledQuery(pageID).execution_options(stream_results=True).yield_per(chunkSize)
+
+    texts = list()
+    classes = list()
+    for text, label in query:
+        texts.append(text)
+        classes.append(label)
+        if len(texts) == chunkSize:
+            yield texts, classes
+            texts = list()
+            classes = list()
+    if texts:
+        yield texts, classes
+
+
+def iterFreshBatches(pageID=None, chunkSize=CHUNK_SIZE):
+    """ Yields (ids, pageIDs, texts) batches of fresh confessions, paging on id so every batch is a small query. """
+    lastID = 0
+    while True:
+        query = Session.query(Confession.id, Confession.page_id, Confession.text)
+        query = query.filter(Confession.status == FRESH, Confession.id > lastID)
+        if pageID:
+            query = query.filter(Confession.page_id == pageID)
+        rows = query.order_by(Confession.id.asc()).limit(chunkSize).all()
+        if not rows:
+            return
+        ids, pageIDs, texts = (list(column) for column in zip(*rows))
+        yield ids, pageIDs, texts
+        lastID = ids[-1]
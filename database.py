@@ -1,27 +1,143 @@
 import os
+import time
 import datetime
 import re
-
-from sqlalchemy import create_engine, or_, and_
-from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.sql import func
-from sqlalchemy import Column, ForeignKey, Integer, Boolean, Enum, String, DateTime, select, Text
+import functools
+import hashlib
+import threading
+from decimal import Decimal, ROUND_HALF_UP
+
+from sqlalchemy import create_engine, event, cast, or_, and_
+from sqlalchemy.exc import SQLAlchemyError, DisconnectionError
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.sql import func, text
+from sqlalchemy import Column, ForeignKey, Index, Integer, Boolean, Enum, Float, Numeric, String, DateTime, select, Text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.associationproxy import association_proxy
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.orm import sessionmaker, scoped_session, relationship, aliased, contains_eager, Session as OrmSession
 
 from util import *
+import config
+import pageQueue
+import metrics
+import tracing
 
 SQLBase = declarative_base()
 
-url = os.environ["DATABASE_URL"]
-engine = create_engine(url)
-SQLBase.metadata.bind = engine
-Session = sessionmaker(bind=engine)
+# Confessions starting with e.g. "#12 " or "@12 " respond to the confession with that index.
+# Both Python and PostgreSQL understand this pattern, the length limit keeps the index within an INTEGER.
+REFERENCE_PATTERN = r'^(?:#|@|@#)(\d{1,9})\s'
+
+# Order in which fresh confessions are sent to the admin: "time" (oldest first) or "score" (likely approvals first).
+# The Redis queues have to be rebuilt after changing it.
+FRESH_ORDER = os.environ.get("FRESH_ORDER", "time")
+UNSCORED = 0.5      # score used for ordering confessions that were not scored yet
+SCORE_DIGITS = 3    # scores are ordered rounded to this many decimals, the oldest goes first within a step
+
+# Hard limits, so a hung query or connection attempt can not hold a worker thread forever. 0 disables them.
+DB_STATEMENT_TIMEOUT = int(os.environ.get("DB_STATEMENT_TIMEOUT", 60))
+DB_CONNECT_TIMEOUT = int(os.environ.get("DB_CONNECT_TIMEOUT", 10))
+
+_engine = None
+_engineLock = threading.Lock()
+
+
+def getEngine():
+    """ The engine is created when it is first used, importing this module does not need a database. """
+    global _engine
+    if _engine is None:
+        with _engineLock:
+            if _engine is None:
+                engine = create_engine(config.databaseUrl(),
+                                       connect_args=connectArgs(config.databaseUrl()),
+                                       pool_size=int(os.environ.get("DB_POOL_SIZE", 5)),
+                                       max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+                                       pool_pre_ping=os.environ.get("DB_POOL_PRE_PING", "1") == "1",
+                                       pool_recycle=int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+                                       )
+                event.listen(engine, "before_cursor_execute", startQueryTimer)
+                event.listen(engine, "after_cursor_execute", recordQueryTime)
+                event.listen(engine, "connect", rememberProcess)
+                event.listen(engine, "checkout", checkProcess)
+                SQLBase.metadata.bind = engine
+                _engine = engine
+    return _engine
+
+
+def connectArgs(url):
+    if make_url(url).get_backend_name() not in ("postgres", "postgresql"):
+        return dict()
+    args = dict()
+    if DB_CONNECT_TIMEOUT:
+        args["connect_timeout"] = DB_CONNECT_TIMEOUT
+    if DB_STATEMENT_TIMEOUT:
+        args["options"] = "-c statement_timeout={}".format(DB_STATEMENT_TIMEOUT * 1000)
+    return args
+
+
+def disposeEngine():
+    """ Close the pooled connections, e.g. before forking processes. """
+    if _engine is not None:
+        _engine.dispose()
+
+
+def startQueryTimer(conn, cursor, statement, parameters, context, executemany):
+    conn.info["queryStart"] = time.time()
+
+
+def recordQueryTime(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info["queryStart"]
+    duration = time.time() - start
+    metrics.observe("sql_query_seconds", duration, statement=statement.lstrip().split(None, 1)[0].upper())
+    if tracing.currentTrace():
+        tracing.record("sql", start, duration, **tracing.statementTags(statement))
+
+
+# Connections of a parent process must not be used, nor closed, by a forked child: that would break them for the parent.
+_inheritedConnections = list()
+
+
+def rememberProcess(dbapiConnection, connectionRecord):
+    connectionRecord.info["pid"] = os.getpid()
+
+
+def checkProcess(dbapiConnection, connectionRecord, connectionProxy):
+    """ A forked process replaces the pooled connections it inherited with its own on first use. """
+    pid = os.getpid()
+    if connectionRecord.info["pid"] != pid:
+        _inheritedConnections.append(dbapiConnection)    # kept open, closing would end the parent's session
+        connectionRecord.connection = connectionProxy.connection = None
+        raise DisconnectionError("Connection of process {} checked out by process {}".format(connectionRecord.info["pid"], pid))
+
+
+class LazySession(OrmSession):
+    def get_bind(self, mapper=None, clause=None):
+        return getEngine()
+
+
+# Every thread gets its own session, it has to be removed when the request or job is done.
+sessionFactory = sessionmaker(class_=LazySession)
+Session = scoped_session(sessionFactory)
+
+
+def removeSession(exception=None):
+    Session.remove()
+
+
+def sessionScope(func):
+    """ Decorator that removes the session of the current thread after func, for jobs outside of a request. """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            Session.remove()
+    return wrapper
 
 
 class Base:
-    session = Session()
+    session = Session
 
     def commit(self):
         try:
@@ -48,7 +164,7 @@ class Page(SQLBase, Base):
     fb_id = Column(String(128), primary_key=True)
     name = Column(String(255))
     token = Column(String(255))
-    admin_messenger_id = Column(String(128))
+    admin_messenger_id = Column(String(128), index=True)
     confessions = relationship("Confession", back_populates="page")
 
     @staticmethod
@@ -56,18 +172,48 @@ class Page(SQLBase, Base):
         page = Page.session.query(Page).filter_by(fb_id=fb_id).one_or_none()
         return page
 
+    @staticmethod
+    def getAll():
+        return Page.session.query(Page).all()
+
     def getFirstFreshConfession(self):
-        return Confession.getFirstFresh(self.fb_id)
+        Page.ensureQueue(self.fb_id)
+        while True:
+            id = pageQueue.firstFresh(self.fb_id)
+            if id is None:
+                return None
+            confession = Confession.findById(id)
+            if confession and confession.status == "fresh" and confession.page_id == self.fb_id:
+                return confession
+            pageQueue.remove(self.fb_id, id)    # out of sync, e.g. deleted from the database
 
     def hasPendingConfession(self):
-        query = select([func.count(Confession.id)], and_(Confession.page_id==self.fb_id, Confession.status=="pending"))
-        amount = query.scalar()
-        return amount > 0
+        Page.ensureQueue(self.fb_id)
+        return pageQueue.hasPending(self.fb_id)
+
+    @staticmethod
+    def ensureQueue(fb_id):
+        if not pageQueue.isBuilt(fb_id):
+            Page.rebuildQueue(fb_id)
+
+    @staticmethod
+    def rebuildQueues():
+        for page in Page.getAll():
+            Page.rebuildQueue(page.fb_id)
+
+    @staticmethod
+    def rebuildQueue(fb_id):
+        """ Load the moderation queue state of the page from the database into Redis. """
+        query = Page.session.query(Confession).filter_by(page_id=fb_id, status="fresh")
+        fresh = [(confession.id, confession.queueRank()) for confession in query]
+        query = Page.session.query(Confession.id).filter_by(page_id=fb_id, status="pending")
+        pending = [id for id, in query]
+        pageQueue.rebuild(fb_id, fresh, pending)
 
     def addConfession(self, text):
         c = Confession()
         c.page = self
-        c.text = text
+        c.setText(text)
         return c
 
 
@@ -86,10 +232,32 @@ class Confession(SQLBase, Base):
     page_id = Column(String(128), ForeignKey(Page.fb_id, onupdate="CASCADE", ondelete="CASCADE"))
     page = relationship("Page", back_populates="confessions")
     status = Column(Enum("fresh", "pending", "posted", "rejected", name="confessionStatusEnum"), default="fresh")
-    text = Column(Text, unique=True)
+    text = Column(Text)
+    text_hash = Column(String(64))  # see Confession.hashText
     time_updated = Column(DateTime, onupdate=datetime.datetime.now)
     fb_id = Column(String(128))
     index = Column(Integer)
+    score = Column(Float)       # predicted probability of being posted, see scoring.py
+    model_version = Column(String(64))
+
+    # see migrate.py, indexes are added to existing databases there
+    __table_args__ = (
+        Index("ix_confession_page_status_timestamp", "page_id", "status", "timestamp"),
+        Index("ix_confession_page_index", "page_id", "index"),
+        Index("ix_confession_page_text_hash", "page_id", "text_hash", unique=True),
+        Index("ix_confession_page_status_score", "page_id", "status", "score"),
+    )
+
+    @staticmethod
+    def hashText(text):
+        """ Hash of the text with case and whitespace normalized, used to detect duplicate submissions. """
+        normalized = " ".join(text.lower().split())
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def isDuplicate(page_id, text_hash):
+        query = Confession.session.query(Confession.id).filter_by(page_id=page_id, text_hash=text_hash)
+        return query.first() is not None
 
     @staticmethod
     def findById(id):
@@ -97,7 +265,7 @@ class Confession(SQLBase, Base):
             confession = Confession.session.query(Confession).filter_by(id=id).one_or_none()
             return confession
         except SQLAlchemyError:
-            log("Failed to query for confession with id: " + str(id))
+            log("Failed to query for confession with id: {}", id)
             return
 
     @staticmethod
@@ -112,20 +280,50 @@ class Confession(SQLBase, Base):
     def getFirstFresh(page_id):
         query = Confession.session.query(Confession)
         query = query.filter_by(page_id=page_id, status="fresh")
+        if FRESH_ORDER == "score":
+            # the same key as queueRank, so the Redis queue and this fallback agree
+            score = cast(func.coalesce(Confession.score, UNSCORED), Numeric)
+            query = query.order_by(func.round(score, SCORE_DIGITS).desc())
         query = query.order_by(Confession.timestamp.asc())
         confession = query.first()
         return confession
 
     @staticmethod
-    def getPending(admin):
-        """ Returns all pending confessions of admin. """
-        query = Confession.session.query(Confession)
-        query = query.filter(Confession.page_id == Page.fb_id)
+    def pendingQuery(admin):
+        """ Query for (confession, referenced confession) of the pending confessions of admin, with their page. """
+        referenced = aliased(Confession)
+        referencedIndex = cast(func.substring(Confession.text, REFERENCE_PATTERN), Integer)
+
+        query = Confession.session.query(Confession, referenced)
+        query = query.join(Confession.page).options(contains_eager(Confession.page))
+        query = query.outerjoin(referenced, and_(referenced.page_id == Confession.page_id, referenced.index == referencedIndex))
         query = query.filter(Confession.status == "pending")
         query = query.filter(Page.admin_messenger_id == admin)
-        pending = query.all()
+        return query.order_by(Confession.timestamp.asc())
+
+    @staticmethod
+    def getPending(admin):
+        """ Returns all pending confessions of admin, their page and referenced confession are loaded in the same query. """
+        pending = list()
+        seen = set()
+        for confession, referencedConfession in Confession.pendingQuery(admin):
+            if confession.id in seen:   # index used twice, keep the first
+                continue
+            seen.add(confession.id)
+            confession._referencedConfession = referencedConfession
+            pending.append(confession)
         return pending
 
+    @staticmethod
+    def bulkSetScores(ids, scores, model_versions):
+        """ Store scores of many confessions with a single UPDATE. Bypasses the session, so queues are not updated. """
+        statement = text("UPDATE confession SET score = v.score, model_version = v.model_version "
+                         "FROM unnest(CAST(:ids AS INTEGER[]), CAST(:scores AS FLOAT[]), CAST(:model_versions AS VARCHAR[])) "
+                         "AS v(id, score, model_version) "
+                         "WHERE confession.id = v.id")
+        Confession.session.execute(statement, {"ids": list(ids), "scores": list(scores), "model_versions": list(model_versions)})
+        Confession.session.commit()
+
     @staticmethod
     def getLastIndex(page_id):
         query = Confession.session.query(func.max(Confession.index))
@@ -134,16 +332,43 @@ class Confession(SQLBase, Base):
         return result if result is not None else 0
 
     def getReferencedConfession(self):
-        result = re.search(r'^(?:\#|\@|\@\#)(\d+)\s', self.text)
+        if "_referencedConfession" in self.__dict__:     # loaded by getPending
+            return self._referencedConfession
+
+        result = re.search(REFERENCE_PATTERN, self.text)
         if result:
             index = result.group(1)
             if index:
                 try:
                     return self.session.query(Confession).filter_by(page_id=self.page_id, index=index).one_or_none()
                 except SQLAlchemyError:
-                    log("Failed to query for confession with index: " + str(index))
+                    log("Failed to query for confession with index: {}", index)
                     return
 
+    def queueRank(self):
+        """ Position in the moderation queue of the page, lower is sent first. """
+        if self.timestamp is None:
+            timestamp = datetime.datetime.now().timestamp()
+        else:
+            timestamp = self.timestamp.timestamp()
+
+        if FRESH_ORDER == "score":
+            # rounded score decides, confessions with the same score are sent oldest first. A score step
+            # is 1e9 seconds, far more than any timestamp span, and the sum stays exact in a double.
+            # Rounded half up like the numeric round() of getFirstFresh, not half to even like round().
+            score = self.score if self.score is not None else UNSCORED
+            steps = int(Decimal(repr(score)).scaleb(SCORE_DIGITS).quantize(Decimal(1), ROUND_HALF_UP))
+            return (10 ** SCORE_DIGITS - steps) * 1e9 + timestamp
+        return timestamp
+
+    def setScore(self, score, model_version):
+        self.score = score
+        self.model_version = model_version
+
+    def setText(self, text):
+        self.text = text
+        self.text_hash = Confession.hashText(text)
+
     def setPosted(self, fb_id, index):
         self.status = "posted"
         self.fb_id = fb_id
@@ -156,8 +381,46 @@ class Confession(SQLBase, Base):
         self.status = "rejected"
 
 
-if not engine.dialect.has_table(engine, "page"):
-    Page.__table__.create(bind=engine)
+@event.listens_for(sessionFactory, "after_flush")
+def collectQueueChanges(session, flushContext):
+    """
+    Remember status transitions of confessions, they are applied to the Redis queues after commit.
+    Only changed statuses are written, a process that e.g. only stored a score must not undo a transition
+    that another process committed in the meantime.
+    """
+    changes = session.info.setdefault("queueChanges", list())
+    ranks = session.info.setdefault("queueRanks", list())
+    for obj in session.new | session.dirty:
+        if not isinstance(obj, Confession):
+            continue
+        if obj in session.new or get_history(obj, "status").has_changes():
+            changes.append((obj.page_id, obj.id, obj.status, obj.queueRank()))
+        elif get_history(obj, "score").has_changes() or get_history(obj, "timestamp").has_changes():
+            ranks.append((obj.page_id, obj.id, obj.queueRank()))
+    for obj in session.deleted:
+        if isinstance(obj, Confession):
+            changes.append((obj.page_id, obj.id, None, None))
+
+
+@event.listens_for(sessionFactory, "after_commit")
+def applyQueueChanges(session):
+    """ The rows are already committed, so a failure of the Redis queues is logged and never raised. """
+    changes = session.info.pop("queueChanges", None) or list()
+    ranks = session.info.pop("queueRanks", None) or list()
+    if changes or ranks:
+        try:
+            pageQueue.update(changes, ranks)
+        except Exception as e:
+            # the queues of these pages can not be trusted anymore, they are rebuilt on next use
+            log("Failed to update moderation queues: {}", e)
+            for pageID in set(change[0] for change in changes + ranks):
+                try:
+                    pageQueue.invalidate(pageID)
+                except Exception as e:
+                    log("Failed to invalidate moderation queue of page {}, rebuild it with rebuildQueues: {}", pageID, e)
+
 
-if not engine.dialect.has_table(engine, "confession"):
-    Confession.__table__.create(bind=engine)
+@event.listens_for(sessionFactory, "after_rollback")
+def discardQueueChanges(session):
+    session.info.pop("queueChanges", None)
+    session.info.pop("queueRanks", None)
@@ -1,43 +1,39 @@
 import re
-import requests
-import json
 from urllib.parse import urljoin
 from util import *
-from database import Page, Confession
+import config
+import graph
+import numbering
+from database import Confession
 from flask import url_for
 import urllib
 
-BASE_URL = "https://graph.facebook.com/v2.9/"
 FB_URL = "https://www.facebook.com/"
-PAGE_ACCESS_TOKEN = os.environ["PAGE_ACCESS_TOKEN"]
-CLIENT_SECRET = os.environ["CLIENT_SECRET"]
-APP_ID = os.environ["APP_ID"]
 
 
 def makeRequest(endpoint, method="GET", access_token=None, **parameters):
-    url = urljoin(BASE_URL, endpoint)
+    url = urljoin(graph.BASE_URL, endpoint)
     if access_token:
         parameters['access_token'] = access_token
 
     if method == "GET":
-        r = requests.get(url, params=parameters)
+        r = graph.get(url, params=parameters)
     elif method == "POST":
-        r = requests.post(url, data=parameters)
+        r = graph.post(url, data=parameters)
     else:
         raise RuntimeError("Unknown request method: " + str(method))
-    if r.status_code == 200:
-        debug("Url: " + str(url))
-        debug("Params: " + str(parameters))
-        printCap = 640
-        printText = str(r.text)[:printCap]
-        if len(r.text) > printCap:
-            printText += " ..."
-        debug("Response: " + printText)
-        return json.loads(r.text)
+    if r is not None and r.status_code == 200:
+        if debugEnabled():
+            printCap = 640
+            printText = r.text[:printCap]
+            if len(r.text) > printCap:
+                printText += " ..."
+            debug("Url: {}\nParams: {}\nResponse: {}", url, parameters, printText)
+        return r.json()
     else:
-        log("Failed to query {}".format(url))
-        log("with params: " + str(parameters))
-        log(r.text)
+        log("Failed to query {} with params: {}", url, parameters)
+        if r is not None:
+            log(r.text)
         return None
 
 
@@ -51,7 +47,7 @@ def postFacebook(endpoint, accessToken, **parameters):
 
 def getClientTokenFromCode(sender, code):
     redirect = loginRedirectURI()
-    data = makeRequest("oauth/access_token", client_id=APP_ID, redirect_uri=redirect, state=sender, client_secret=CLIENT_SECRET, code=code)
+    data = makeRequest("oauth/access_token", client_id=config.appID(), redirect_uri=redirect, state=sender, client_secret=config.clientSecret(), code=code)
     if not data:
         return None
 
@@ -82,9 +78,9 @@ postUrl = objectUrl
 def loginUrl(sender, scopes):
     url = "https://www.facebook.com/v2.9/dialog/oauth"
     redirectURI = urllib.parse.quote(loginRedirectURI())
-    url += "?redirect_uri={}&client_id={}&scope={}".format(redirectURI, APP_ID, scopes)
+    url += "?redirect_uri={}&client_id={}&scope={}".format(redirectURI, config.appID(), scopes)
     url += "&state={}".format(str(sender))
-    log("Login URL: " + url)
+    log("Login URL: {}", url)
     return url
 
 
@@ -174,20 +170,31 @@ class FBPage(FBObject):
                 if index:
                     return index
 
+    def findLastConfessionIndex(self):
+        """ Highest confession number used on the page feed or in the database. """
+        return max(self.getLastConfessionIndex() or 0, Confession.getLastIndex(self.id))
+
+    def allocateConfessionIndex(self):
+        if not numbering.isInitialized(self.id):
+            numbering.initialize(self.id, self.findLastConfessionIndex())
+        return numbering.allocate(self.id)
+
+    def reconcileConfessionIndex(self):
+        """ Move the number counter forward if posts were numbered outside of the bot. """
+        return numbering.reconcile(self.id, self.findLastConfessionIndex())
+
     def postConfession(self, confession):
         referencedConfession = confession.getReferencedConfession()
         if not referencedConfession:
-            lastIndex = self.getLastConfessionIndex()
-            debug("Last index: " + str(lastIndex))
-            if lastIndex:
-                index = lastIndex + 1
-            else:
-                index = Confession.getLastIndex(self.id) + 1
+            index = self.allocateConfessionIndex()
+            debug("Allocated index: {}", index)
 
             message = "#{} {}".format(str(index), confession.text)
             response = self.post("feed", message=message)
             if response:
                 return response.get("id"), index
+            if not numbering.release(self.id, index):
+                log("Confession number {} of page {} is skipped", index, self.id)
         else:
             post = FBPost(referencedConfession.fb_id, token=self.token)
             id = post.addComment(confession.text)
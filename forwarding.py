@@ -0,0 +1,44 @@
+from rq.decorators import job
+
+from util import *
+from worker import conn, MESSAGES
+import graph
+
+# Requests for some pages are handled by another bot, e.g.
+# FORWARD_PAGES="942723909080518=https://party-post.herokuapp.com/messenger,1911537602473957=https://..."
+DEFAULT_FORWARD_PAGES = "942723909080518=https://party-post.herokuapp.com/messenger," \
+                        "1911537602473957=https://party-post.herokuapp.com/messenger"
+FORWARD_TIMEOUT = float(os.environ.get("FORWARD_TIMEOUT", 10))
+# Headers that are not passed on, the receiving end sets its own.
+SKIPPED_HEADERS = {"host", "content-length", "connection"}
+
+
+def parseForwardPages(value):
+    """ Returns dict from page id to destination url. """
+    pages = dict()
+    for rule in value.split(","):
+        if rule.strip():
+            pageID, url = rule.split("=", 1)
+            pages[pageID.strip()] = url.strip()
+    return pages
+
+
+FORWARD_PAGES = parseForwardPages(os.environ.get("FORWARD_PAGES", DEFAULT_FORWARD_PAGES))
+
+
+def getDestination(pageID):
+    return FORWARD_PAGES.get(pageID)
+
+
+def forwardHeaders(headers):
+    return {key: value for key, value in headers.items() if key.lower() not in SKIPPED_HEADERS}
+
+
+@job(MESSAGES, connection=conn)
+def forward(destinationUrl, body, headers, traceID=None):
+    """ Forward the raw request to another bot, the body is unchanged so its signature stays valid. """
+    headers = dict(headers)
+    headers.setdefault("Content-Type", "application/json")
+    response = graph.post(destinationUrl, headers=headers, data=body, allow_redirects=False, timeout=FORWARD_TIMEOUT)
+    if response is None or response.status_code >= 400:
+        log("Failed to forward request to {}: {}", destinationUrl, response.status_code if response is not None else "no response")
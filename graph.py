@@ -0,0 +1,168 @@
+import re
+import time
+import random
+import threading
+from urllib.parse import urljoin, urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from flask import has_request_context
+
+from util import *
+import rateLimit
+import metrics
+import tracing
+
+# Can be pointed to a local stand-in server for testing.
+BASE_URL = os.environ.get("GRAPH_URL", "https://graph.facebook.com/v2.9/")
+CONNECT_TIMEOUT = float(os.environ.get("GRAPH_CONNECT_TIMEOUT", 3.05))
+READ_TIMEOUT = float(os.environ.get("GRAPH_READ_TIMEOUT", 15))
+MAX_RETRIES = int(os.environ.get("GRAPH_MAX_RETRIES", 3))
+BACKOFF = float(os.environ.get("GRAPH_BACKOFF", 0.5))
+MAX_BACKOFF = 30
+POOL_SIZE = int(os.environ.get("GRAPH_POOL_SIZE", 10))
+
+# Graph API error codes that signal throttling. (https://developers.facebook.com/docs/graph-api/using-graph-api/error-handling)
+RATE_LIMIT_CODES = {4, 17, 32, 613}
+
+_session = None
+_sessionPid = None
+_stats = dict()
+_statsLock = threading.Lock()
+
+
+def getSession():
+    """ Returns the keep-alive session of this process. Connections are never shared with forked children. """
+    global _session, _sessionPid
+    if _session is None or _sessionPid != os.getpid():
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=0)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _session = session
+        _sessionPid = os.getpid()
+    return _session
+
+
+def get(endpoint, **kwargs):
+    return request("GET", endpoint, **kwargs)
+
+
+def post(endpoint, **kwargs):
+    return request("POST", endpoint, **kwargs)
+
+
+def request(method, endpoint, timeout=None, retries=MAX_RETRIES, **kwargs):
+    """
+    Perform a request to the Graph API, endpoint can be relative to BASE_URL or a full url.
+    Transient failures are retried with exponential backoff.
+    Returns the response or None if no response could be obtained.
+    """
+    url = urljoin(BASE_URL, endpoint)
+    if timeout is None:
+        timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+    name = endpointName(url)
+    token = accessToken(kwargs)
+    # only background jobs wait long for the rate limit, a web request goes ahead
+    maxWait = rateLimit.REQUEST_MAX_WAIT if has_request_context() else rateLimit.MAX_WAIT
+
+    attempt = 0
+    while True:
+        if token:
+            with tracing.span("graph rate limit"):
+                rateLimit.acquire(token, maxWait)
+        start = time.time()
+        response = None
+        try:
+            response = getSession().request(method, url, timeout=timeout, **kwargs)
+        except requests.exceptions.ConnectTimeout as e:
+            retryable = True
+            log("Connecting to {} timed out: {}", name, e, endpoint=name)
+        except requests.exceptions.RequestException as e:
+            # the request might have been received, only send it again when that is harmless
+            retryable = method == "GET"
+            log("Request to {} failed: {}", name, e, endpoint=name)
+        else:
+            retryable = isRetryable(response, method)
+            rateLimit.observe(token, response.headers)
+            if isRateLimited(response):
+                rateLimit.throttled(token)
+        duration = time.time() - start
+        recordStat(name, duration, response is None or response.status_code != 200)
+        status = str(response.status_code) if response is not None else "error"
+        metrics.observe("graph_request_seconds", duration, endpoint=name, method=method, status=status)
+        tracing.record("{} {}".format(method, name), start, duration, status=status, attempt=attempt)
+
+        if not retryable or attempt >= retries:
+            return response
+
+        delay = retryDelay(response, attempt)
+        debug("Retrying request to {} in {:.2f}s", name, delay, endpoint=name)
+        time.sleep(delay)
+        attempt += 1
+
+
+def accessToken(kwargs):
+    """ The access token of the call, rate limits are kept per token. """
+    for name in ("params", "data"):
+        parameters = kwargs.get(name)
+        if isinstance(parameters, dict) and parameters.get("access_token"):
+            return parameters["access_token"]
+
+
+def isRetryable(response, method):
+    """
+    Other 5xx errors can come from a proxy after Facebook handled the request, so a POST is only sent again
+    when it was throttled or the service was unavailable, otherwise it could e.g. post a confession twice.
+    """
+    if isRateLimited(response):
+        return True
+    if method == "GET":
+        return response.status_code >= 500
+    return response.status_code == 503
+
+
+def isRateLimited(response):
+    if response.status_code == 429:
+        return True
+    if response.status_code < 400:
+        return False
+    try:
+        error = response.json().get("error", dict())
+    except ValueError:
+        return False
+    return error.get("code") in RATE_LIMIT_CODES
+
+
+def retryDelay(response, attempt):
+    if response is not None:
+        retryAfter = response.headers.get("Retry-After")
+        if retryAfter and retryAfter.isdigit():
+            return min(float(retryAfter), MAX_BACKOFF)
+    delay = BACKOFF * (2 ** attempt)
+    return min(delay + random.uniform(0, delay / 2), MAX_BACKOFF)
+
+
+def endpointName(url):
+    """ Name used to group stats, object ids are replaced so all pages and posts end up in the same group. """
+    path = urlparse(url).path
+    return re.sub(r"/\d+(_\d+)?(?=/|$)", "/{id}", path)
+
+
+def recordStat(name, duration, failed):
+    with _statsLock:
+        stat = _stats.setdefault(name, {"count": 0, "errors": 0, "total": 0.0, "max": 0.0})
+        stat["count"] += 1
+        stat["total"] += duration
+        stat["max"] = max(stat["max"], duration)
+        if failed:
+            stat["errors"] += 1
+
+
+def stats():
+    """ Returns per endpoint latency stats of this process: count, errors, mean and max duration in seconds. """
+    with _statsLock:
+        result = dict()
+        for name, stat in _stats.items():
+            result[name] = dict(stat, mean=stat["total"] / stat["count"])
+        return result
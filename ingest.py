@@ -0,0 +1,120 @@
+import time
+import socket
+import traceback
+
+from redis.exceptions import ResponseError
+
+from util import *
+from worker import conn
+from database import Session
+import tracing
+
+STREAM = os.environ.get("INGEST_STREAM", "webhook")
+GROUP = os.environ.get("INGEST_GROUP", "consumers")
+CONSUMER = os.environ.get("DYNO", socket.gethostname()) + "-" + str(os.getpid())
+# Approximate amount of entries kept in the stream, acknowledged or not.
+MAX_LENGTH = int(os.environ.get("INGEST_MAX_LENGTH", 100000))
+BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", 50))
+BLOCK_MS = 5000
+# Entries that were delivered to a consumer but not acknowledged for this long are taken over by another one.
+CLAIM_IDLE_MS = 60000
+
+
+def append(body, signature, traceID=None):
+    """ Append a raw webhook request to the stream. This is the only work done while Facebook waits. """
+    fields = ["body", body, "signature", signature]
+    if traceID:
+        fields += ["trace", traceID]
+    conn.execute_command("XADD", STREAM, "MAXLEN", "~", MAX_LENGTH, "*", *fields)
+
+
+def createGroup():
+    try:
+        conn.execute_command("XGROUP", "CREATE", STREAM, GROUP, "$", "MKSTREAM")
+    except ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+def readGroup(lastID, block=None):
+    """ Returns list of (id, fields) delivered to this consumer. """
+    command = ["XREADGROUP", "GROUP", GROUP, CONSUMER, "COUNT", BATCH_SIZE]
+    if block:
+        command += ["BLOCK", block]
+    command += ["STREAMS", STREAM, lastID]
+    response = conn.execute_command(*command)
+    if not response:
+        return list()
+    return parseEntries(response[0][1])
+
+
+def claimStale():
+    """ Take over entries of consumers that died before acknowledging them. """
+    pending = conn.execute_command("XPENDING", STREAM, GROUP, "-", "+", BATCH_SIZE)
+    ids = [entryID for entryID, consumer, idle, deliveries in pending if idle >= CLAIM_IDLE_MS]
+    if not ids:
+        return list()
+    claimed = conn.execute_command("XCLAIM", STREAM, GROUP, CONSUMER, CLAIM_IDLE_MS, *ids)
+    return parseEntries(claimed)
+
+
+def parseEntries(entries):
+    result = list()
+    for entryID, values in entries:
+        if values is None:      # entry was trimmed from the stream
+            conn.execute_command("XACK", STREAM, GROUP, entryID)
+            continue
+        fields = dict(zip(values[::2], values[1::2]))
+        result.append((entryID, fields))
+    return result
+
+
+def processBatch(entries):
+    """ Dispatch all events in the batch and acknowledge them with a single command. """
+    import app
+
+    for entryID, fields in entries:
+        traceID = fields.get(b"trace")
+        with tracing.activate(traceID.decode("utf-8") if traceID else None):
+            # entry ids start with the time they were appended in milliseconds
+            appended = int(entryID.split(b"-")[0]) / 1000
+            tracing.record("stream wait", appended, time.time() - appended, stream=STREAM)
+            try:
+                with tracing.span("ingest", consumer=CONSUMER):
+                    body = fields[b"body"]
+                    signature = fields[b"signature"].decode("utf-8")
+                    data = json.loads(body.decode("utf-8"))
+                    headers = {"X-Hub-Signature": signature, "Content-Type": "application/json"}
+                    app.dispatchEvents(data, body, headers, runNow)
+            except Exception as e:
+                app.adminBot.exceptionOccured(e)
+                traceback.print_exc()
+
+    Session.remove()
+    tracing.flush()
+    if entries:
+        conn.execute_command("XACK", STREAM, GROUP, *[entryID for entryID, fields in entries])
+
+
+def runNow(handler, *args):
+    with tracing.span("handle " + handler.__name__):
+        handler(*args)
+
+
+def consume():
+    createGroup()
+    log("Consumer {} reading from stream '{}'", CONSUMER, STREAM)
+
+    # first handle entries that were delivered to this consumer before, but never acknowledged
+    entries = readGroup("0")
+    while entries:
+        processBatch(entries)
+        entries = readGroup("0")
+
+    while True:
+        processBatch(claimStale())
+        processBatch(readGroup(">", block=BLOCK_MS))
+
+
+if __name__ == '__main__':
+    consume()
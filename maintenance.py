@@ -0,0 +1,32 @@
+import bacli
+
+from util import *
+from database import Page, sessionScope
+from facebook import FBPage
+import numbering
+import metrics
+
+bacli.setDescription("Periodic maintenance tasks, e.g. for the Heroku scheduler")
+
+
+@bacli.command
+@sessionScope
+def reconcileIndexes():
+    """ Check the confession number counters of all pages against their feeds. """
+    for page in Page.getAll():
+        if not page.token:
+            continue
+        before = numbering.current(page.fb_id)
+        after = FBPage(page).reconcileConfessionIndex()
+        if before is not None and after != before:
+            log("Confession number of {} moved from {} to {}", page.name, before, after)
+        else:
+            log("Confession number of {} is {}", page.name, after)
+
+
+@bacli.command
+def queues():
+    """ Report the depth and wait times of the job queues. """
+    print("{:<10} {:>6} {:>12} {:>10} {:>8}".format("queue", "jobs", "oldest (s)", "mean wait", "workers"))
+    for stat in metrics.queueStats():
+        print("{queue:<10} {jobs:>6} {oldest:>12.1f} {meanWait:>10.2f} {workers:>8}".format(**stat))
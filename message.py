@@ -1,11 +1,17 @@
-import requests
 import json
+from urllib.parse import urlencode
 
 from util import *
+import config
+import graph
 
-MESSAGE_URL = "https://graph.facebook.com/v2.9/me/messages"
-PARAMS = {"access_token": os.environ["PAGE_ACCESS_TOKEN"]}
+MESSAGE_ENDPOINT = "me/messages"
 HEADERS = {"Content-Type": "application/json"}
+BATCH_LIMIT = 50    # maximum amount of requests in one Graph batch request
+
+
+def params():
+    return {"access_token": config.pageAccessToken()}
 
 
 class Message:
@@ -19,18 +25,86 @@ class Message:
         return data
 
     def send(self, recipient):
-        log("sending message to {}".format(recipient))
+        debug("sending message to {}", recipient)
 
-        data = self.getData()
-        data["recipient"]["id"] = recipient
+        data = self.getSendData(recipient)
         jsonData = json.dumps(data)
-        r = requests.post(MESSAGE_URL, params=PARAMS, headers=HEADERS, data=jsonData)
+        r = graph.post(MESSAGE_ENDPOINT, params=params(), headers=HEADERS, data=jsonData)
+        if r is None:
+            return False
         if r.status_code != 200:
-            log(r.status_code)
-            log(r.text)
+            error("Failed to send message to {}: {} {}", recipient, r.status_code, r.text)
             return False
         return True
 
+    def getSendData(self, recipient):
+        data = self.getData()
+        data["recipient"]["id"] = recipient
+        return data
+
+
+class MessageBatch:
+    """ Sends several messages with as few Graph batch requests as possible, keeping their order. """
+    def __init__(self):
+        self.items = list()
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, message, recipient):
+        self.items.append((message, recipient))
+
+    def send(self):
+        """
+        Returns a list with the status of each message.
+        A message is only sent when all messages before it were sent successfully.
+        """
+        if len(self.items) == 1:
+            message, recipient = self.items[0]
+            return [message.send(recipient)]
+
+        statuses = list()
+        for start in range(0, len(self.items), BATCH_LIMIT):
+            chunk = self.items[start:start+BATCH_LIMIT]
+            if statuses and not statuses[-1]:
+                statuses.extend([False] * len(chunk))
+            else:
+                statuses.extend(self.sendChunk(chunk))
+        return statuses
+
+    def sendChunk(self, chunk):
+        debug("sending batch of {} messages", len(chunk))
+
+        batch = list()
+        for i, (message, recipient) in enumerate(chunk):
+            data = message.getSendData(recipient)
+            request = {
+                "method": "POST",
+                "name": "message{}".format(i),
+                "relative_url": MESSAGE_ENDPOINT,
+                "body": urlencode({key: json.dumps(value) for key, value in data.items()}),
+                "omit_response_on_success": False,
+            }
+            if i > 0:
+                # chain the requests, Graph executes independent requests in parallel
+                request["depends_on"] = "message{}".format(i - 1)
+            batch.append(request)
+
+        r = graph.post("", params=params(), data={"batch": json.dumps(batch)})
+        if r is None:
+            return [False] * len(chunk)
+        if r.status_code != 200:
+            error("Failed to send batch of {} messages: {} {}", len(chunk), r.status_code, r.text)
+            return [False] * len(chunk)
+
+        statuses = list()
+        for response in r.json():
+            status = response is not None and response.get("code") == 200
+            if not status:
+                log(response)
+            statuses.append(status)
+        return statuses
+
 
 class TextMessage(Message):
     def __init__(self, text):
@@ -154,8 +228,10 @@ class Element:
 class Button:
     def __init__(self, text, data):
         self.text = text
-        if type(data) == dict:
+        if type(data) == str:
             self.payload = data
+        elif type(data) == dict:
+            self.payload = json.dumps(data)
         else:
             raise RuntimeError("Button payload has unknown type: " + str(type(data)))
 
@@ -163,7 +239,7 @@ class Button:
         return {
             "type": "postback",
             "title": self.text,
-            "payload": json.dumps(self.payload)
+            "payload": self.payload
         }
 
 
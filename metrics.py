@@ -0,0 +1,156 @@
+import time
+import json
+import threading
+from collections import defaultdict
+
+from rq import Queue, Worker
+from rq.utils import utcnow
+
+from util import *
+from worker import conn, listen
+
+# Jobs run in forked processes and the web and worker dynos are separate machines, so histograms are
+# aggregated in Redis. Observations are buffered per process and written in one round trip.
+FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", 10))
+METRICS_PORT = os.environ.get("METRICS_PORT")    # worker side exporter, off unless set
+PREFIX = "metrics:"
+
+FAST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+REQUEST_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+JOB_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800, 3600)
+
+HISTOGRAMS = {
+    "webhook_seconds": ("Handling of webhook requests.", REQUEST_BUCKETS),
+    "graph_request_seconds": ("Graph API calls per endpoint, retries included separately.", REQUEST_BUCKETS),
+    "sql_query_seconds": ("SQL queries per statement type.", FAST_BUCKETS),
+    "job_seconds": ("Runtime of background jobs.", JOB_BUCKETS),
+    "job_wait_seconds": ("Time jobs waited in their queue.", JOB_BUCKETS),
+}
+
+_pending = defaultdict(float)   # (name, field) -> increment
+_lastFlush = time.time()
+_lock = threading.Lock()
+
+
+def labelKey(labels):
+    return json.dumps(sorted(labels.items()), separators=(",", ":"))
+
+
+def observe(name, value, **labels):
+    """ Record a value in one of the HISTOGRAMS. """
+    buckets = HISTOGRAMS[name][1]
+    key = labelKey(labels)
+    bucket = next((str(bound) for bound in buckets if value <= bound), "+Inf")
+    with _lock:
+        _pending[(name, key + "|" + bucket)] += 1
+        _pending[(name, key + "|sum")] += value
+        due = time.time() - _lastFlush > FLUSH_INTERVAL
+    if due:
+        flush()
+
+
+def flush():
+    """ Write buffered observations to Redis, jobs call this before their process exits. """
+    global _pending, _lastFlush
+    with _lock:
+        pending, _pending = _pending, defaultdict(float)
+        _lastFlush = time.time()
+    if not pending:
+        return
+    try:
+        pipe = conn.pipeline(transaction=False)
+        for (name, field), increment in pending.items():
+            pipe.hincrbyfloat(PREFIX + name, field, increment)
+        pipe.execute()
+    except Exception as e:
+        log("Failed to write metrics: {}", e)
+
+
+def queueStats():
+    """ Per queue: waiting jobs, age of the oldest one, workers listening and mean wait of the jobs that ran. """
+    waits = defaultdict(lambda: [0.0, 0.0])     # queue -> [total wait, jobs]
+    for field, value in conn.hgetall(PREFIX + "job_wait_seconds").items():
+        key, _, bucket = field.decode("utf-8").rpartition("|")
+        queue = dict(json.loads(key)).get("queue")
+        waits[queue][0 if bucket == "sum" else 1] += float(value)
+
+    workers = Worker.all(connection=conn)
+    stats = list()
+    for name in listen:
+        queue = Queue(name, connection=conn)
+        first = queue.get_job_ids(0, 1)
+        job = queue.fetch_job(first[0]) if first else None
+        total, count = waits[name]
+        stats.append({
+            "queue": name,
+            "jobs": queue.count,
+            "oldest": (utcnow() - job.enqueued_at).total_seconds() if job and job.enqueued_at else 0.0,
+            "workers": sum(1 for worker in workers if name in worker.queue_names()),
+            "meanWait": total / count if count else 0.0,
+        })
+    return stats
+
+
+class RedisCollector:
+    """ Exposes the histograms in Redis together with gauges that are read at scrape time. """
+    def collect(self):
+        from prometheus_client.core import HistogramMetricFamily, GaugeMetricFamily, CounterMetricFamily
+
+        for name, (documentation, buckets) in HISTOGRAMS.items():
+            series = defaultdict(dict)
+            for field, value in conn.hgetall(PREFIX + name).items():
+                key, _, bucket = field.decode("utf-8").rpartition("|")
+                series[key][bucket] = float(value)
+
+            labelNames = None
+            family = None
+            for key, values in sorted(series.items()):
+                labels = json.loads(key)
+                if family is None:
+                    labelNames = [label for label, _ in labels]
+                    family = HistogramMetricFamily("confessions_" + name, documentation, labels=labelNames)
+                cumulative = 0
+                points = list()
+                for bound in [str(bound) for bound in buckets] + ["+Inf"]:
+                    cumulative += values.get(bound, 0)
+                    points.append((bound, cumulative))
+                family.add_metric([value for _, value in labels], points, values.get("sum", 0))
+            if family is not None:
+                yield family
+
+        depth = GaugeMetricFamily("confessions_queue_jobs", "Jobs waiting in each queue.", labels=["queue"])
+        oldest = GaugeMetricFamily("confessions_queue_oldest_job_seconds", "Age of the oldest waiting job in each queue.", labels=["queue"])
+        for stat in queueStats():
+            depth.add_metric([stat["queue"]], stat["jobs"])
+            oldest.add_metric([stat["queue"]], stat["oldest"])
+        yield depth
+        yield oldest
+
+        import cache
+        requests = CounterMetricFamily("confessions_page_cache_requests", "Page info cache lookups.", labels=["result"])
+        for result, count in cache.stats().items():
+            requests.add_metric([result], count)
+        yield requests
+
+
+def registry():
+    from prometheus_client import CollectorRegistry
+    collectorRegistry = CollectorRegistry(auto_describe=False)
+    collectorRegistry.register(RedisCollector())
+    return collectorRegistry
+
+
+def exposition():
+    """ Returns (body, content type) for a /metrics response. """
+    from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+    flush()
+    return generate_latest(registry()), CONTENT_TYPE_LATEST
+
+
+def startExporter(port=METRICS_PORT):
+    """ Serve /metrics from the worker, for deployments where it can be scraped. """
+    if not port:
+        return
+    from prometheus_client import start_http_server
+    start_http_server(int(port), registry=registry())
+    log("Serving metrics on port {}", port)
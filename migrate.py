@@ -0,0 +1,176 @@
+import datetime
+
+import bacli
+from sqlalchemy import MetaData, Table, Column, ForeignKey, Integer, String, DateTime, Enum, Text, select, and_
+from sqlalchemy.sql import func
+
+from util import *
+from database import getEngine, Session, Page, Confession
+
+BACKFILL_BATCH = 1000
+
+bacli.setDescription("Versioned schema migrations for the Confessions database")
+
+
+VERSION_TABLE = "schema_version"
+
+
+def initialSchema(connection):
+    """ Tables as they were created before migrations existed. """
+    metadata = MetaData()
+    Table("page", metadata,
+          Column("fb_id", String(128), primary_key=True),
+          Column("name", String(255)),
+          Column("token", String(255)),
+          Column("admin_messenger_id", String(128)),
+          )
+    Table("confession", metadata,
+          Column("id", Integer, primary_key=True, autoincrement=True),
+          Column("timestamp", DateTime),
+          Column("page_id", String(128), ForeignKey("page.fb_id", onupdate="CASCADE", ondelete="CASCADE")),
+          Column("status", Enum("fresh", "pending", "posted", "rejected", name="confessionStatusEnum")),
+          Column("text", Text, unique=True),
+          Column("time_updated", DateTime),
+          Column("fb_id", String(128)),
+          Column("index", Integer),
+          )
+    metadata.create_all(bind=connection, checkfirst=True)
+
+
+def confessionIndexes(connection):
+    """ Composite indexes for the moderation queue, pending review and index lookups. """
+    connection.execute('CREATE INDEX IF NOT EXISTS ix_confession_page_status_timestamp ON confession (page_id, status, "timestamp")')
+    connection.execute('CREATE INDEX IF NOT EXISTS ix_confession_page_index ON confession (page_id, "index")')
+    connection.execute('CREATE INDEX IF NOT EXISTS ix_page_admin_messenger_id ON page (admin_messenger_id)')
+
+
+def confessionTextHash(connection):
+    """ Per page content hash instead of a unique constraint on the full text. """
+    connection.execute("ALTER TABLE confession ADD COLUMN IF NOT EXISTS text_hash VARCHAR(64)")
+
+    # Older duplicates that only differ in case or whitespace keep an empty hash, they do not conflict.
+    existing = connection.execute("SELECT page_id, text_hash FROM confession WHERE text_hash IS NOT NULL")
+    seen = set(tuple(row) for row in existing)
+    rows = connection.execution_options(stream_results=True).execute(
+        "SELECT id, page_id, text FROM confession WHERE text_hash IS NULL ORDER BY id")
+    update = "UPDATE confession SET text_hash = %(text_hash)s WHERE id = %(id)s"
+    updates = list()
+    for id, page_id, text in rows:
+        key = (page_id, Confession.hashText(text or ""))
+        if key in seen:
+            continue
+        seen.add(key)
+        updates.append({"id": id, "text_hash": key[1]})
+        if len(updates) == BACKFILL_BATCH:
+            connection.execute(update, updates)
+            updates = list()
+    if updates:
+        connection.execute(update, updates)
+
+    connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS ix_confession_page_text_hash ON confession (page_id, text_hash)")
+    connection.execute("ALTER TABLE confession DROP CONSTRAINT IF EXISTS confession_text_key")
+
+
+def confessionScore(connection):
+    """ Classifier score and model version of confessions. """
+    connection.execute("ALTER TABLE confession ADD COLUMN IF NOT EXISTS score FLOAT")
+    connection.execute("ALTER TABLE confession ADD COLUMN IF NOT EXISTS model_version VARCHAR(64)")
+    connection.execute("CREATE INDEX IF NOT EXISTS ix_confession_page_status_score ON confession (page_id, status, score)")
+
+
+# Ordered list of (version, migration). Never change a migration that was released, add a new one instead.
+MIGRATIONS = [
+    (1, initialSchema),
+    (2, confessionIndexes),
+    (3, confessionTextHash),
+    (4, confessionScore),
+]
+
+
+def versionTable(metadata):
+    return Table(VERSION_TABLE, metadata,
+                 Column("version", Integer, primary_key=True),
+                 Column("description", String(255)),
+                 Column("applied_at", DateTime, default=datetime.datetime.now),
+                 )
+
+
+def getCurrentVersion(connection):
+    table = versionTable(MetaData())
+    table.create(bind=connection, checkfirst=True)
+    version = connection.execute(select([func.max(table.c.version)])).scalar()
+    return version if version is not None else 0
+
+
+@bacli.command
+def upgrade():
+    """ Apply all migrations that were not applied yet. """
+    table = versionTable(MetaData())
+    with getEngine().begin() as connection:
+        current = getCurrentVersion(connection)
+
+    for version, migration in MIGRATIONS:
+        if version <= current:
+            continue
+        description = migration.__doc__.strip()
+        log("Applying migration {}: {}", version, description)
+        with getEngine().begin() as connection:
+            connection.execute("SET LOCAL statement_timeout = 0")     # building indexes may take a while
+            migration(connection)
+            connection.execute(table.insert().values(version=version, description=description))
+
+    log("Schema is at version {}", MIGRATIONS[-1][0])
+
+
+@bacli.command
+def status():
+    """ Show current schema version and pending migrations. """
+    with getEngine().begin() as connection:
+        current = getCurrentVersion(connection)
+    print("Current version: {}".format(current))
+    for version, migration in MIGRATIONS:
+        if version > current:
+            print("Pending: {} {}".format(version, migration.__doc__.strip()))
+
+
+def hotQueries(pageID, admin):
+    """ The queries of the moderation hot path, as built in database.py. """
+    session = Session()
+    return {
+        "getFirstFresh": session.query(Confession)
+            .filter_by(page_id=pageID, status="fresh")
+            .order_by(Confession.timestamp.asc())
+            .limit(1),
+        "hasPendingConfession": select([func.count(Confession.id)],
+                                       and_(Confession.page_id == pageID, Confession.status == "pending")),
+        "getPending": Confession.pendingQuery(admin).with_labels(),
+        "getLastIndex": session.query(func.max(Confession.index)).filter_by(page_id=pageID),
+        "getReferencedConfession": session.query(Confession).filter_by(page_id=pageID, index=1),
+    }
+
+
+@bacli.command
+def explain():
+    """ Check with EXPLAIN that the hot queries can use an index instead of scanning the confession table. """
+    page = Session().query(Page).first()
+    pageID = page.fb_id if page else "0"
+    admin = page.admin_messenger_id if page else "0"
+
+    failed = list()
+    engine = getEngine()
+    with engine.connect() as connection:
+        transaction = connection.begin()
+        # small tables are always scanned, this shows whether an index is usable at all
+        connection.execute("SET LOCAL enable_seqscan = off")
+        for name, query in hotQueries(pageID, admin).items():
+            statement = getattr(query, "statement", query)
+            compiled = statement.compile(dialect=engine.dialect)
+            plan = "\n".join(row[0] for row in connection.execute("EXPLAIN " + str(compiled), compiled.params))
+            print("{}:\n{}\n".format(name, plan))
+            if "Seq Scan on confession" in plan:
+                failed.append(name)
+        transaction.rollback()
+
+    if failed:
+        raise RuntimeError("Sequential scan on confession in: " + ", ".join(failed))
+    print("All hot queries use an index.")
@@ -0,0 +1,137 @@
+import time
+import json
+import datetime
+
+from util import *
+
+# Layout: MODEL_DIR/<name>/<version>/{model.pkl,meta.json} and MODEL_DIR/<name>/CURRENT with the promoted version.
+MODEL_DIR = os.environ.get("MODEL_DIR", "models")
+SHARED = "shared"
+# Seconds between checks whether another version was promoted.
+RELOAD_INTERVAL = float(os.environ.get("MODEL_RELOAD_INTERVAL", 60))
+
+_loaded = dict()    # name -> (version, pipeline, time of last check)
+_index = (None, 0)  # (pages with their own model, time of last check)
+
+
+def modelDir(name, version):
+    return os.path.join(MODEL_DIR, name, version)
+
+
+def save(pipeline, meta, name=SHARED):
+    """ Store a new version of the model with its metadata, returns the version. """
+    from sklearn.externals import joblib
+
+    # page models are saved in parallel, a version that was just taken by another process is skipped
+    while True:
+        version = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        directory = modelDir(name, version)
+        try:
+            os.makedirs(directory)
+            break
+        except FileExistsError:
+            continue
+    # not compressed, so numpy arrays can be memory mapped when loading
+    joblib.dump(pipeline, os.path.join(directory, "model.pkl"))
+    meta = dict(meta, name=name, version=version, created=datetime.datetime.now().isoformat())
+    with open(os.path.join(directory, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+    log("Saved model {} version {}", name, version)
+    return version
+
+
+def promote(version, name=SHARED):
+    """ Make version the current model, running workers pick it up within RELOAD_INTERVAL. """
+    if not os.path.exists(modelDir(name, version)):
+        raise RuntimeError("No version {} of model {}".format(version, name))
+    pointer = os.path.join(MODEL_DIR, name, "CURRENT")
+    with open(pointer + ".tmp", "w") as f:
+        f.write(version)
+    os.replace(pointer + ".tmp", pointer)
+    log("Promoted model {} version {}", name, version)
+
+
+def currentVersion(name=SHARED):
+    try:
+        with open(os.path.join(MODEL_DIR, name, "CURRENT")) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def listVersions(name=SHARED):
+    directory = os.path.join(MODEL_DIR, name)
+    if not os.path.isdir(directory):
+        return list()
+    return sorted(entry for entry in os.listdir(directory) if os.path.isdir(os.path.join(directory, entry)))
+
+
+def getMeta(version, name=SHARED):
+    with open(os.path.join(modelDir(name, version), "meta.json")) as f:
+        return json.load(f)
+
+
+def load(version, name=SHARED):
+    """ Load a model, its numpy arrays are memory mapped and shared between processes by the page cache. """
+    from sklearn.externals import joblib
+    return joblib.load(os.path.join(modelDir(name, version), "model.pkl"), mmap_mode='r')
+
+
+def getModel(name=SHARED):
+    """ Returns (pipeline, version) of the current model, (None, None) if nothing was promoted. """
+    version, pipeline, checked = _loaded.get(name, (None, None, 0))
+    if time.time() - checked < RELOAD_INTERVAL:
+        return pipeline, version
+
+    current = currentVersion(name)
+    if current != version:
+        pipeline = load(current, name) if current else None
+        version = current
+        log("Loaded model {} version {}", name, version)
+    _loaded[name] = (version, pipeline, time.time())
+    return pipeline, version
+
+
+def writeIndex(pages):
+    """ Store which pages have their own model, all other pages use the shared one. """
+    index = {
+        "updated": datetime.datetime.now().isoformat(),
+        "fallback": SHARED,
+        "pages": sorted(pages),
+    }
+    path = os.path.join(MODEL_DIR, "index.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(index, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def getIndexedPages():
+    global _index
+    pages, checked = _index
+    if time.time() - checked >= RELOAD_INTERVAL:
+        try:
+            with open(os.path.join(MODEL_DIR, "index.json")) as f:
+                pages = set(json.load(f)["pages"])
+        except FileNotFoundError:
+            pages = set()
+        _index = (pages, time.time())
+    return pages
+
+
+def getModelForPage(pageID):
+    """ Returns (pipeline, name/version) of the model that scores confessions of the page. """
+    name = str(pageID) if str(pageID) in getIndexedPages() else SHARED
+    pipeline, version = getModel(name)
+    if pipeline is None and name != SHARED:
+        name = SHARED
+        pipeline, version = getModel(name)
+    if pipeline is None:
+        return None, None
+    return pipeline, name + "/" + version
+
+
+def loadAll():
+    """ Load or refresh the shared model and all page models. """
+    getModel(SHARED)
+    for pageID in getIndexedPages():
+        getModel(pageID)
@@ -0,0 +1,57 @@
+from worker import conn
+
+# Per page counter of the last allocated confession number (#N). INCR makes allocation atomic across workers.
+PREFIX = "confession:index:"
+
+# Only give a number back if no other number was allocated after it, otherwise it is skipped.
+RELEASE_SCRIPT = conn.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DECR', KEYS[1])
+    return 1
+end
+return 0
+""")
+
+# Move the counter forward to at least the given index, it never goes back.
+RAISE_SCRIPT = conn.register_script("""
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+local index = tonumber(ARGV[1])
+if current < index then
+    redis.call('SET', KEYS[1], index)
+    return index
+end
+return current
+""")
+
+
+def counterKey(pageID):
+    return PREFIX + str(pageID)
+
+
+def isInitialized(pageID):
+    return conn.exists(counterKey(pageID))
+
+
+def initialize(pageID, lastIndex):
+    """ Seed the counter with the last used index, unless another process already did. """
+    conn.set(counterKey(pageID), int(lastIndex), nx=True)
+
+
+def allocate(pageID):
+    """ Returns the next confession number of the page. """
+    return conn.incr(counterKey(pageID))
+
+
+def release(pageID, index):
+    """ Give back a number that was not used. Returns False if it could not be given back and is skipped. """
+    return RELEASE_SCRIPT(keys=[counterKey(pageID)], args=[int(index)]) == 1
+
+
+def reconcile(pageID, lastIndex):
+    """ Make sure the counter is not behind the last index used on the page. Returns the counter. """
+    return RAISE_SCRIPT(keys=[counterKey(pageID)], args=[int(lastIndex)])
+
+
+def current(pageID):
+    value = conn.get(counterKey(pageID))
+    return int(value) if value is not None else None
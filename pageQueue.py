@@ -0,0 +1,99 @@
+from worker import conn
+
+# Per page moderation state kept in Redis, so the hot path needs no aggregate queries:
+#  - fresh:   sorted set of fresh confession ids, ranked by the order they should be sent to the admin.
+#  - pending: set of confession ids that were sent to the admin.
+#  - built:   marker that the state was loaded from the database, see database.Page.rebuildQueue.
+PREFIX = "queue:"
+
+# Sets the rank of each confession that is still fresh, KEYS are fresh sets and ARGV pairs of confessionID, rank.
+RERANK_SCRIPT = conn.register_script("""
+for i, key in ipairs(KEYS) do
+    if redis.call('ZSCORE', key, ARGV[2 * i - 1]) then
+        redis.call('ZADD', key, ARGV[2 * i], ARGV[2 * i - 1])
+    end
+end
+""")
+
+
+def freshKey(pageID):
+    return PREFIX + str(pageID) + ":fresh"
+
+
+def pendingKey(pageID):
+    return PREFIX + str(pageID) + ":pending"
+
+
+def builtKey(pageID):
+    return PREFIX + str(pageID) + ":built"
+
+
+def isBuilt(pageID):
+    return conn.exists(builtKey(pageID))
+
+
+def rebuild(pageID, fresh, pending):
+    """ Replace the state of a page. fresh is a list of (confessionID, rank), pending a list of confessionIDs. """
+    pipe = conn.pipeline()
+    pipe.delete(freshKey(pageID), pendingKey(pageID))
+    if fresh:
+        pipe.zadd(freshKey(pageID), **{str(id): rank for id, rank in fresh})
+    if pending:
+        pipe.sadd(pendingKey(pageID), *pending)
+    pipe.set(builtKey(pageID), 1)
+    pipe.execute()
+
+
+def invalidate(pageID):
+    conn.delete(builtKey(pageID))
+
+
+def update(changes, ranks=()):
+    """
+    Apply status transitions, changes is a list of (pageID, confessionID, status, rank).
+    ranks is a list of (pageID, confessionID, rank) for confessions whose status did not change, their rank is
+    only updated when they are still fresh, another process may have moved them on in the meantime.
+    """
+    if not changes and not ranks:
+        return
+    pipe = conn.pipeline()
+    for pageID, id, status, rank in changes:
+        if status == "fresh":
+            pipe.zadd(freshKey(pageID), **{str(id): rank})
+        else:
+            pipe.zrem(freshKey(pageID), id)
+
+        if status == "pending":
+            pipe.sadd(pendingKey(pageID), id)
+        else:
+            pipe.srem(pendingKey(pageID), id)
+    if ranks:
+        args = list()
+        for _, id, rank in ranks:
+            args += [id, rank]
+        RERANK_SCRIPT(keys=[freshKey(pageID) for pageID, _, _ in ranks], args=args, client=pipe)
+    pipe.execute()
+
+
+def remove(pageID, id):
+    update([(pageID, id, None, None)])
+
+
+def firstFresh(pageID):
+    """ Returns the id of the first fresh confession or None. """
+    ids = conn.zrange(freshKey(pageID), 0, 0)
+    if ids:
+        return int(ids[0])
+
+
+def hasPending(pageID):
+    return conn.scard(pendingKey(pageID)) > 0
+
+
+def depth(pageID):
+    """ Amount of fresh confessions waiting for the page. """
+    return conn.zcard(freshKey(pageID))
+
+
+def pendingCount(pageID):
+    return conn.scard(pendingKey(pageID))
@@ -1,19 +1,18 @@
-import os
 import json
-import requests
 from util import *
+import config
+import graph
 from chatbot import ConfessionsBot
 
-PROFILE_URL = "https://graph.facebook.com/v2.9/me/messenger_profile"
-PARAMS = {"access_token": os.environ["PAGE_ACCESS_TOKEN"]}
+PROFILE_ENDPOINT = "me/messenger_profile"
 HEADERS = {"Content-Type": "application/json"}
 SUPPORTED_LANGUAGES = ["en_US", "nl_BE"]
 
 
 def post(data):
     jsonData = json.dumps(data)
-    r = requests.post(PROFILE_URL, params=PARAMS, headers=HEADERS, data=jsonData)
-    if r.status_code != 200:
+    r = graph.post(PROFILE_ENDPOINT, params={"access_token": config.pageAccessToken()}, headers=HEADERS, data=jsonData)
+    if r is not None and r.status_code != 200:
         log(r.status_code)
         log(r.text)
 
@@ -29,15 +28,10 @@ def setup():
     post(data)
 
 
-def getStartedButtonData(payload=None):
-    if payload is None:
-        payload = {
-            "type": "action",
-            "action": "welcome"
-        }
+def getStartedButtonData():
     data = {
         "get_started": {
-            "payload": json.dumps(ConfessionsBot.sendWelcome())
+            "payload": ConfessionsBot.sendWelcome()
         }
     }
     return data
@@ -67,12 +61,12 @@ def getMenuData():
                     {
                         "title": "List pages",
                         "type": "postback",
-                        "payload": json.dumps(ConfessionsBot.listPages())
+                        "payload": ConfessionsBot.listPages()
                     },
                     {
                         "title": "Resend Pending",
                         "type": "postback",
-                        "payload": json.dumps(ConfessionsBot.sendPending())
+                        "payload": ConfessionsBot.sendPending()
                     }
                 ]
             },
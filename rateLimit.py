@@ -0,0 +1,132 @@
+import time
+import json
+import hashlib
+
+from util import *
+from worker import conn
+
+# Token bucket per access token, shared by all processes through Redis.
+RATE = float(os.environ.get("GRAPH_RATE", 10))          # requests per second
+BURST = float(os.environ.get("GRAPH_BURST", 20))
+MAX_WAIT = float(os.environ.get("GRAPH_MAX_WAIT", 30))  # seconds a call waits for a token before going ahead anyway
+# The same for calls made while handling a web request, they must not hold up a gunicorn worker.
+REQUEST_MAX_WAIT = float(os.environ.get("GRAPH_REQUEST_MAX_WAIT", 0))
+# Facebook reports usage of its rate limits in percent, above this the rate is lowered step by step.
+SLOWDOWN_THRESHOLD = float(os.environ.get("GRAPH_SLOWDOWN_THRESHOLD", 75))
+MIN_FACTOR = 0.05
+FACTOR_TTL = 120    # seconds a lowered rate stays in effect without new usage headers
+
+PREFIX = "ratelimit:"
+APP_KEY = "app"
+
+# Returns the amount of milliseconds to wait, 0 when a token was taken.
+TAKE_SCRIPT = conn.register_script("""
+local rate = tonumber(ARGV[1]) / 1000
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = math.ceil((1 - tokens) / rate)
+end
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate) + 1000)
+return wait
+""")
+
+
+def tokenKey(token):
+    """ Access tokens are not stored in Redis, only a hash of them. """
+    return hashlib.sha1(token.encode("utf-8")).hexdigest()[:16]
+
+
+def acquire(token, maxWait=MAX_WAIT):
+    """ Wait until a call with the token is allowed. Returns False if that took more than maxWait. """
+    key = tokenKey(token)
+    waited = 0.0
+    try:
+        while True:
+            rate = RATE * getFactor(key)
+            wait = TAKE_SCRIPT(keys=[PREFIX + key + ":bucket"], args=[rate, BURST, int(time.time() * 1000)]) / 1000
+            if wait == 0:
+                return True
+            if waited + wait > maxWait:
+                if waited:
+                    warning("Rate limit: waited {:.1f}s for a Graph call, going ahead", waited)
+                else:
+                    debug("Rate limit: no token for a Graph call, going ahead")
+                return False
+            time.sleep(wait)
+            waited += wait
+    except Exception as e:     # never fail a call because the limiter is unavailable
+        log("Rate limiter failed: {}", e)
+        return True
+
+
+def getFactor(key):
+    """ Fraction of RATE currently allowed for the token, the lowest of the app and the token. """
+    values = conn.mget(PREFIX + APP_KEY + ":factor", PREFIX + key + ":factor")
+    factors = [float(value) for value in values if value is not None]
+    return min(factors) if factors else 1.0
+
+
+def setFactor(key, factor):
+    conn.set(PREFIX + key + ":factor", max(MIN_FACTOR, min(1.0, factor)), ex=FACTOR_TTL)
+
+
+def usageFactor(usage):
+    """ 1 below the threshold, going down to MIN_FACTOR at 100% usage. """
+    if usage <= SLOWDOWN_THRESHOLD:
+        return 1.0
+    return (100 - usage) / (100 - SLOWDOWN_THRESHOLD)
+
+
+def maxUsage(header):
+    """ Highest percentage in a usage header, e.g. {"call_count": 28, "total_time": 25, "total_cputime": 25}. """
+    try:
+        data = json.loads(header)
+    except ValueError:
+        return 0
+    entries = list()
+    if isinstance(data, dict) and "call_count" in data:
+        entries.append(data)
+    elif isinstance(data, dict):     # X-Business-Use-Case-Usage: {"<id>": [{"type": "pages", "call_count": ..}, ..]}
+        for value in data.values():
+            if isinstance(value, list):
+                entries.extend(value)
+    usage = 0
+    for entry in entries:
+        for name in ("call_count", "total_time", "total_cputime"):
+            usage = max(usage, entry.get(name, 0) or 0)
+    return usage
+
+
+def observe(token, headers):
+    """ Lower the rate before Facebook starts throttling, based on the usage headers of a response. """
+    try:
+        appUsage = headers.get("X-App-Usage")
+        if appUsage:
+            setFactor(APP_KEY, usageFactor(maxUsage(appUsage)))
+
+        usage = 0
+        for name in ("X-Page-Usage", "X-Business-Use-Case-Usage"):
+            header = headers.get(name)
+            if header:
+                usage = max(usage, maxUsage(header))
+        if token and usage:
+            setFactor(tokenKey(token), usageFactor(usage))
+    except Exception as e:
+        log("Rate limiter failed: {}", e)
+
+
+def throttled(token):
+    """ Facebook throttled a call, slow down as much as possible for a while. """
+    try:
+        setFactor(tokenKey(token) if token else APP_KEY, MIN_FACTOR)
+    except Exception as e:
+        log("Rate limiter failed: {}", e)
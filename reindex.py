@@ -0,0 +1,88 @@
+from rq.decorators import job
+
+from util import *
+from worker import conn, BULK
+from database import Confession, Session, sessionScope
+from message import TextMessage
+import facebook
+
+CHUNK_SIZE = 50             # maximum amount of ids in one Graph lookup
+PROGRESS_INTERVAL = 20      # chunks between progress messages to the admin
+JOB_TIMEOUT = 3600          # the job can be started again and continues at its checkpoint
+CHECKPOINT_KEY = "reindex:checkpoint"
+LOCK_KEY = "reindex:running"
+
+
+@job(BULK, connection=conn, timeout=JOB_TIMEOUT)
+@sessionScope
+def reindexConfessions(admin, restart=False):
+    """ Fetch the numbers of all posted confessions from their posts, in chunks that are committed separately. """
+    if not conn.set(LOCK_KEY, admin, ex=JOB_TIMEOUT, nx=True):
+        TextMessage("Indexing is already running.").send(admin)
+        return
+
+    try:
+        if restart:
+            conn.delete(CHECKPOINT_KEY)
+        checkpoint = conn.get(CHECKPOINT_KEY)
+        lastID = int(checkpoint) if checkpoint else 0
+
+        remaining = postedQuery(lastID).count()
+        if lastID:
+            TextMessage("Continuing indexing after confession {}, {} to go.".format(lastID, remaining)).send(admin)
+        else:
+            TextMessage("Indexing {} confessions.".format(remaining)).send(admin)
+
+        done = 0
+        updated = 0
+        chunks = 0
+        while True:
+            chunk = postedQuery(lastID).order_by(Confession.id.asc()).limit(CHUNK_SIZE).all()
+            if not chunk:
+                break
+
+            indexes = fetchIndexes(chunk)
+            for confession in chunk:
+                index = indexes.get(confession.fb_id)
+                if index and index != confession.index:
+                    confession.index = index
+                    updated += 1
+            Session.commit()
+
+            lastID = chunk[-1].id
+            conn.set(CHECKPOINT_KEY, lastID)
+            Session.expunge_all()     # keep memory flat, chunks are not needed anymore
+
+            done += len(chunk)
+            chunks += 1
+            if chunks % PROGRESS_INTERVAL == 0:
+                TextMessage("Indexed {} of {} confessions.".format(done, remaining)).send(admin)
+
+        conn.delete(CHECKPOINT_KEY)
+        TextMessage("Finished indexing, updated {} of {} confessions.".format(updated, done)).send(admin)
+    finally:
+        conn.delete(LOCK_KEY)
+
+
+def postedQuery(lastID):
+    query = Session.query(Confession).filter(Confession.status == "posted", Confession.id > lastID)
+    return query.filter(Confession.fb_id.isnot(None))
+
+
+def fetchIndexes(confessions):
+    """ Returns dict from post id to confession number, with one Graph request per page. """
+    byToken = dict()
+    for confession in confessions:
+        byToken.setdefault(confession.page.token, list()).append(confession.fb_id)
+
+    indexes = dict()
+    for token, ids in byToken.items():
+        response = facebook.makeRequest("", access_token=token, ids=",".join(ids), fields="message")
+        if not response:
+            log("Failed to fetch {} posts for indexing", len(ids))
+            continue
+        for id, data in response.items():
+            text = data.get("message")
+            if text:
+                indexes[id] = facebook.FBPost(id, text).getIndex()
+    return indexes
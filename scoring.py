@@ -0,0 +1,42 @@
+from rq.decorators import job
+
+from util import *
+from worker import conn, BACKGROUND
+from database import Confession, sessionScope
+import modelRegistry
+
+SCORE_CONFESSIONS = os.environ.get("SCORE_CONFESSIONS", "1") == "1"
+
+
+def loadModels():
+    """ The worker calls this before forking a job, so the models are shared and newly promoted ones are picked up. """
+    modelRegistry.loadAll()
+
+
+def predictPosted(pipeline, texts):
+    """ Probability of being posted for each text. """
+    from dataSource import POSTED
+    column = list(pipeline.classes_).index(POSTED)
+    return pipeline.predict_proba(texts)[:, column]
+
+
+def scoreLater(confession):
+    if SCORE_CONFESSIONS:
+        scoreConfession.delay(confession.id)
+
+
+@job(BACKGROUND, connection=conn)
+@sessionScope
+def scoreConfession(confessionID):
+    confession = Confession.findById(confessionID)
+    if confession is None:
+        return
+
+    pipeline, version = modelRegistry.getModelForPage(confession.page_id)
+    if pipeline is None:
+        log("No model to score confession {}", confessionID)
+        return
+    score = predictPosted(pipeline, [confession.text])[0]
+    confession.setScore(float(score), version)
+    confession.save()
+    debug("Scored confession {}: {:.3f}", confessionID, score)
@@ -0,0 +1,127 @@
+import time
+import json
+import atexit
+import random
+import threading
+import contextlib
+
+import requests
+
+from util import *
+
+# Spans are written in the Zipkin v2 JSON format, as JSON lines to TRACE_FILE and/or in batches to a
+# collector at TRACE_URL (e.g. http://zipkin:9411/api/v2/spans). Tracing is off when neither is set.
+TRACE_FILE = os.environ.get("TRACE_FILE")
+TRACE_URL = os.environ.get("TRACE_URL")
+TRACE_SAMPLE = float(os.environ.get("TRACE_SAMPLE", 1))     # fraction of webhook requests that is traced
+ENABLED = bool(TRACE_FILE or TRACE_URL)
+# The heroku dyno type, e.g. "web" or "worker".
+SERVICE = os.environ.get("TRACE_SERVICE", "confessions-" + os.environ.get("DYNO", "local").split(".")[0])
+FLUSH_INTERVAL = float(os.environ.get("TRACE_FLUSH_INTERVAL", 5))
+MAX_STATEMENT_LENGTH = 200
+
+_context = threading.local()    # trace id and stack of open span ids of the current thread
+_pending = list()
+_lastFlush = time.time()
+_lock = threading.Lock()
+
+
+def newTrace():
+    """ Returns the id for a new trace, None if this one is not traced. """
+    if not ENABLED or random.random() >= TRACE_SAMPLE:
+        return None
+    return os.urandom(16).hex()
+
+
+def currentTrace():
+    return getattr(_context, "trace", None)
+
+
+@contextlib.contextmanager
+def activate(traceID):
+    """ Spans recorded by this thread within the block belong to the trace. """
+    previous = (currentTrace(), getattr(_context, "stack", None))
+    _context.trace, _context.stack = traceID, list()
+    try:
+        yield
+    finally:
+        _context.trace, _context.stack = previous
+
+
+@contextlib.contextmanager
+def span(name, **tags):
+    """ Record the block as a span, nested spans get it as their parent. """
+    if currentTrace() is None:
+        yield
+        return
+
+    spanID = os.urandom(8).hex()
+    parentID = _context.stack[-1] if _context.stack else None
+    _context.stack.append(spanID)
+    start = time.time()
+    try:
+        yield
+    except Exception as e:
+        tags["error"] = type(e).__name__
+        raise
+    finally:
+        _context.stack.pop()
+        record(name, start, time.time() - start, spanID=spanID, parentID=parentID, **tags)
+
+
+def record(name, start, duration, spanID=None, parentID=None, **tags):
+    """ Record a span that was measured elsewhere, e.g. the time a job waited in its queue. """
+    traceID = currentTrace()
+    if traceID is None:
+        return
+
+    if parentID is None and _context.stack:
+        parentID = _context.stack[-1]
+    entry = {
+        "traceId": traceID,
+        "id": spanID or os.urandom(8).hex(),
+        "name": name,
+        "timestamp": int(start * 1000000),
+        "duration": max(1, int(duration * 1000000)),
+        "localEndpoint": {"serviceName": SERVICE},
+        "tags": {key: str(value) for key, value in tags.items()},
+    }
+    if parentID:
+        entry["parentId"] = parentID
+
+    with _lock:
+        _pending.append(entry)
+        due = time.time() - _lastFlush > FLUSH_INTERVAL
+    if due:
+        flush()
+
+
+def statementTags(statement):
+    """ Tags for a SQL span, long statements are cut off. """
+    return {
+        "sql.type": statement.lstrip().split(None, 1)[0].upper(),
+        "sql.statement": statement[:MAX_STATEMENT_LENGTH],
+    }
+
+
+def flush():
+    """ Export the spans recorded so far, jobs call this before their process exits. """
+    global _pending, _lastFlush
+    with _lock:
+        spans, _pending = _pending, list()
+        _lastFlush = time.time()
+    if not spans:
+        return
+
+    try:
+        if TRACE_FILE:
+            # a single append per flush, so lines of concurrent processes do not interleave
+            with open(TRACE_FILE, "a") as f:
+                f.write("".join(json.dumps(entry) + "\n" for entry in spans))
+        if TRACE_URL:
+            requests.post(TRACE_URL, json=spans, timeout=2)
+    except Exception as e:
+        log("Failed to export {} spans: {}", len(spans), e)
+
+
+atexit.register(flush)
@@ -1,22 +1,154 @@
 import os
 import sys
 import json
+import queue
+import atexit
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
 
 # If in debug mode.
 DEBUG = os.getenv("DEBUG", False)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG" if DEBUG else "INFO").upper()
+# "text" for people reading heroku logs, "json" for log drains that parse the fields.
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
 
+logger = logging.getLogger("confessions")
 
-def log(message="", debug=False):
-    """ Simple wrapper for logging to stdout on heroku. """
-    if debug and not DEBUG:     # Do not print debug if not requested
+
+class LazyMessage:
+    """ Message formatted with str.format only when a handler actually writes it. """
+    def __init__(self, message, args):
+        self.message = message
+        self.args = args
+
+    def __str__(self):
+        return str(self.message).format(*self.args)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(levelname)s %(message)s")
+
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join("{}={}".format(key, value) for key, value in fields.items())
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", None) or dict())
+        return json.dumps(entry, default=str)
+
+
+class BufferedHandler(QueueHandler):
+    """
+    Hands records to a background thread that writes them to stdout, so logging never blocks on the pipe.
+    Threads do not survive a fork, so a forked process starts its own writer.
+    """
+    def __init__(self, handler):
+        super().__init__(queue.Queue())
+        self.handler = handler
+        self.pid = None
+        self.listener = None
+        self.flushedPid = None
+        self.startLock = threading.Lock()
+
+    def prepare(self, record):
+        # The message is formatted here, the formatter of the writer adds the level and fields.
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.msg += "\n" + logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        if self.flushedPid == os.getpid():
+            # e.g. bacli runs its commands from an atexit handler, after the writer was stopped
+            self.handler.handle(self.prepare(record))
+            return
+        if self.pid != os.getpid():
+            self.start()
+        super().emit(record)
+
+    def start(self):
+        with self.startLock:
+            if self.pid == os.getpid():
+                return
+            self.queue = queue.Queue()  # records queued by the parent are its own to write
+            self.listener = QueueListener(self.queue, self.handler)
+            self.listener.start()
+            self.pid = os.getpid()
+
+    def flush(self):
+        """
+        Write everything queued so far, e.g. before a forked job calls os._exit or the process exits.
+        Later records of this process are written directly.
+        """
+        with self.startLock:
+            if self.pid == os.getpid() and self.listener:
+                self.listener.stop()
+                self.pid = None
+            self.flushedPid = os.getpid()
+        self.handler.flush()
+
+
+def setupLogging():
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter())
+    handler = BufferedHandler(stream)
+    logger.addHandler(handler)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+    atexit.register(handler.flush)
+    return handler
+
+
+_handler = setupLogging()
+
+
+def log(message="", *args, debug=False, level=logging.INFO, exc_info=False, **fields):
+    """
+    Log a message, formatted lazily with str.format(*args) when the level is enabled.
+    Keyword arguments are added as structured fields.
+    """
+    if debug:
+        level = logging.DEBUG
+    if not logger.isEnabledFor(level):
         return
 
-    print(message)
-    sys.stdout.flush()
+    if args:
+        message = LazyMessage(message, args)
+    logger.log(level, message, exc_info=exc_info, extra={"fields": fields} if fields else None)
+
+
+def debug(message="", *args, **fields):
+    log(message, *args, debug=True, **fields)
+
+
+def warning(message="", *args, **fields):
+    log(message, *args, level=logging.WARNING, **fields)
+
+
+def error(message="", *args, **fields):
+    log(message, *args, level=logging.ERROR, **fields)
+
+
+def debugEnabled():
+    return logger.isEnabledFor(logging.DEBUG)
 
 
-def debug(message=""):
-    log(message, debug=True)
+def flushLogs():
+    _handler.flush()
 
 
 # class CustomEncoder(json.JSONEncoder):
@@ -1,14 +1,315 @@
 import os
+import sys
+import time
+import signal
+import importlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import redis
 from rq import Worker, Queue, Connection
+from rq.utils import utcnow
+from rq.worker import WorkerStatus
+from rq.exceptions import DequeueTimeout
+from rq.timeouts import BaseDeathPenalty, JobTimeoutException
 
-listen = ['high', 'default', 'low']
-redis_url = os.getenv('REDIS_URL')
+# Routing: every job is decorated with the queue of its kind.
+POSTBACKS = 'high'      # an admin is waiting for the result of a button tap
+MESSAGES = 'default'    # incoming messages and forwarded requests
+BACKGROUND = 'low'      # scoring and cache refreshes
+BULK = 'bulk'           # long running maintenance, it has its own workers so it never delays the others
+listen = [POSTBACKS, MESSAGES, BACKGROUND, BULK]
+
+# "fork" forks a work horse for every job, "pool" runs jobs in threads of long lived worker processes.
+WORKER_MODE = os.getenv('WORKER_MODE', 'fork')
+WORKER_THREADS = int(os.getenv('WORKER_THREADS', 4))   # jobs running at the same time in a pooled worker
+POLL_INTERVAL = 1       # seconds a pooled worker waits for a job before checking for shutdown and overdue jobs
+HEARTBEAT_INTERVAL = 15
+
+# Modules with jobs, imported before forking so work horses do not import them again for every job.
+JOB_MODULES = ['app', 'cache', 'chatbot', 'forwarding', 'reindex', 'scoring']
+
+redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379')
 conn = redis.from_url(redis_url)
 queue = Queue(connection=conn)
 
-if __name__ == '__main__':
+
+class ModelWorker(Worker):
+    """ Loads the current model before forking, so jobs share it and pick up newly promoted ones. """
+    # the forked work horse exits without running atexit handlers
+    flushAfterJob = True
+
+    def execute_job(self, *args, **kwargs):
+        import scoring
+        self.dequeuedAt = time.time()
+        scoring.loadModels()
+        return super().execute_job(*args, **kwargs)
+
+    def perform_job(self, job, queue, dequeuedAt=None):
+        import metrics
+        import tracing
+        from util import flushLogs
+
+        start = time.time()
+        dequeuedAt = dequeuedAt or getattr(self, "dequeuedAt", start)
+        succeeded = False
+        try:
+            # jobs enqueued by the webhook continue its trace
+            with tracing.activate(job.kwargs.get("traceID")):
+                if job.enqueued_at:
+                    wait = (utcnow() - job.enqueued_at).total_seconds() - (start - dequeuedAt)
+                    metrics.observe("job_wait_seconds", wait, queue=queue.name)
+                    tracing.record("enqueue wait", dequeuedAt - wait, wait, queue=queue.name)
+                tracing.record("job start", dequeuedAt, start - dequeuedAt, queue=queue.name)
+                with tracing.span("job " + job.func_name, queue=queue.name):
+                    succeeded = super().perform_job(job, queue)
+            return succeeded
+        finally:
+            metrics.observe("job_seconds", time.time() - start, job=job.func_name, queue=queue.name,
+                            status="ok" if succeeded else "failed")
+            if self.flushAfterJob:
+                metrics.flush()
+                tracing.flush()
+                flushLogs()
+
+
+class NoDeathPenalty(BaseDeathPenalty):
+    """ Threads cannot be interrupted, the pooled worker enforces the timeout of its jobs itself. """
+    def setup_death_penalty(self):
+        pass
+
+    def cancel_death_penalty(self):
+        pass
+
+
+class PooledWorker(ModelWorker):
+    """
+    Runs jobs in a pool of threads instead of forking for every job, so database connections, HTTP keep-alive
+    connections and loaded models are reused. Jobs are only taken from Redis when a thread is free.
+    A job that runs past its timeout is failed and its thread left behind, the worker then stops taking jobs
+    and exits once the others are done, so runWorkers starts a fresh process.
+    """
+    flushAfterJob = False
+    death_penalty_class = NoDeathPenalty
+
+    def __init__(self, queues, threads=WORKER_THREADS, **kwargs):
+        super().__init__(queues, **kwargs)
+        self.pool = ThreadPoolExecutor(threads)
+        self.slots = threading.BoundedSemaphore(threads)
+        self.running = dict()       # job id -> (job, deadline), rq itself only tracks a single current job
+        self.abandoned = set()      # ids of jobs that exceeded their timeout
+        self.runningLock = threading.Lock()
+        self.lastHeartbeat = 0
+
+    def set_state(self, state, pipeline=None):
+        # rq sets busy and idle around each job, the state reflects all running jobs instead
+        if state in (WorkerStatus.BUSY, WorkerStatus.IDLE):
+            state = WorkerStatus.BUSY if self.running else WorkerStatus.IDLE
+        super().set_state(state, pipeline=pipeline)
+
+    def set_current_job_id(self, job_id, pipeline=None):
+        with self.runningLock:
+            oldest = next(iter(self.running), None)
+        super().set_current_job_id(oldest, pipeline=pipeline)
+
+    def dequeue_job_and_maintain_ttl(self, timeout):
+        """ Wait for a free thread, then for a job, in short steps so shutdown requests and overdue jobs are noticed. """
+        while not self.slots.acquire(timeout=POLL_INTERVAL):
+            if not self.checkRunning():
+                return None
+
+        self.set_state(WorkerStatus.IDLE)
+        self.procline('Listening on {0}'.format(','.join(self.queue_names())))
+        while True:
+            if not self.checkRunning():
+                self.slots.release()
+                return None
+            try:
+                # timeout None is burst mode, it does not block
+                result = self.queue_class.dequeue_any(self.queues, POLL_INTERVAL if timeout else None,
+                                                      connection=self.connection, job_class=self.job_class)
+            except DequeueTimeout:
+                continue
+            if result is None:
+                self.slots.release()
+            else:
+                job, queue = result
+                self.log.info('{0}: {1} ({2})'.format(queue.name, job.description, job.id))
+            return result
+
+    def execute_job(self, job, queue):
+        import scoring
+        dequeuedAt = time.time()
+        scoring.loadModels()
+        with self.runningLock:
+            self.running[job.id] = (job, dequeuedAt + (job.timeout or self.queue_class.DEFAULT_TIMEOUT))
+        future = self.pool.submit(self.perform_job, job, queue, dequeuedAt)
+        future.add_done_callback(lambda future: self.finished(job))
+
+    def finished(self, job):
+        with self.runningLock:
+            self.running.pop(job.id, None)
+        self.slots.release()
+        if job.id not in self.abandoned:
+            self.set_state(WorkerStatus.IDLE)
+            self.set_current_job_id(None)
+
+    def checkRunning(self):
+        """ Heartbeat and give up on overdue jobs. Returns False when the worker should not take more jobs. """
+        now = time.time()
+        if now - self.lastHeartbeat >= HEARTBEAT_INTERVAL:
+            self.heartbeat()
+            self.lastHeartbeat = now
+
+        with self.runningLock:
+            overdue = [job for job, deadline in self.running.values() if deadline < now]
+            for job in overdue:
+                del self.running[job.id]
+                self.abandoned.add(job.id)
+        for job in overdue:
+            self.abandon(job)
+        return not (self._stop_requested or self.abandoned)
+
+    def abandon(self, job):
+        """ Fail a job that exceeded its timeout, its thread keeps its slot as it can not be stopped. """
+        from util import error
+
+        timeout = job.timeout or self.queue_class.DEFAULT_TIMEOUT
+        error("Job {} exceeded its timeout of {}s, the worker exits after its other jobs", job.id, timeout)
+        try:
+            raise JobTimeoutException("Job exceeded maximum timeout value ({} seconds)".format(timeout))
+        except JobTimeoutException:
+            with Connection(self.connection):   # the failed queue uses the connection of the current thread
+                super().handle_job_failure(job)
+                super().handle_exception(job, *sys.exc_info())
+        self.set_state(WorkerStatus.IDLE)
+        self.set_current_job_id(None)
+
+    # a job that finishes after it was given up on must not overwrite its failure
+
+    def handle_job_success(self, job, queue, started_job_registry):
+        if job.id not in self.abandoned:
+            super().handle_job_success(job, queue, started_job_registry)
+
+    def handle_job_failure(self, job, started_job_registry=None):
+        if job.id not in self.abandoned:
+            super().handle_job_failure(job, started_job_registry)
+
+    def handle_exception(self, job, *exc_info):
+        if job.id not in self.abandoned:
+            super().handle_exception(job, *exc_info)
+
+    def register_death(self):
+        """ Called when the work loop ends, the worker stays registered until its jobs are done. """
+        while True:
+            self.checkRunning()
+            with self.runningLock:
+                if not self.running:
+                    break
+            time.sleep(POLL_INTERVAL)
+        super().register_death()
+
+    def work(self, *args, **kwargs):
+        import metrics
+        import tracing
+        from util import flushLogs
+
+        try:
+            return super().work(*args, **kwargs)
+        finally:
+            # abandoned threads are not waited for, runWorkers exits the process with os._exit
+            self.pool.shutdown(wait=False)
+            metrics.flush()
+            tracing.flush()
+            flushLogs()
+
+
+def queuesFor(name):
+    """ Queues of a worker dedicated to a queue: workers also take more urgent jobs, but only bulk workers take bulk jobs. """
+    if name == BULK:
+        return [BULK]
+    return [queue for queue in listen[:listen.index(name) + 1] if queue != BULK]
+
+
+def concurrency(name):
+    """ Amount of worker processes for the queue, e.g. WORKERS_HIGH=2. """
+    return int(os.environ.get("WORKERS_" + name.upper(), 1))
+
+
+def preloadJobModules():
+    for name in JOB_MODULES:
+        importlib.import_module(name)
+
+
+def runWorker(queues):
+    workerClass = PooledWorker if WORKER_MODE == 'pool' else ModelWorker
     with Connection(conn):
-        worker = Worker(map(Queue, listen))
+        worker = workerClass(map(Queue, queues))
         worker.work()
+
+
+def probe(url=None):
+    """ Small job for benchmark.py: a database round trip and optionally an HTTP request. """
+    from database import Session
+    import graph
+
+    try:
+        Session.execute("SELECT 1")
+        if url:
+            graph.get(url, retries=0)
+    finally:
+        Session.remove()
+
+
+def runWorkers(names):
+    """
+    Start the worker processes for the queues and start them again when they die.
+    Heroku and the terminal signal the whole process group, so the workers shut down on their own.
+    """
+    from util import log
+
+    workers = [queuesFor(name) for name in names for _ in range(concurrency(name))]
+    if len(workers) == 1 and WORKER_MODE != 'pool':     # a pooled worker exits after a job exceeded its timeout
+        return runWorker(workers[0])
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    def spawn(queues):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                runWorker(queues)
+            finally:
+                os._exit(0)
+        return pid
+
+    children = {spawn(queues): queues for queues in workers}
+    while children:
+        try:
+            pid, status = os.wait()
+        except InterruptedError:
+            continue
+        queues = children.pop(pid, None)
+        if queues and not stopping:
+            log("Worker for {} exited with status {}, starting a new one", ",".join(queues), status)
+            time.sleep(1)
+            children[spawn(queues)] = queues
+
+
+if __name__ == '__main__':
+    from database import Page, disposeEngine
+    import metrics
+    Page.rebuildQueues()
+    disposeEngine()     # the workers are forked, they must not share the connections of this process
+    preloadJobModules()
+    metrics.startExporter()
+
+    runWorkers(sys.argv[1:] or listen)